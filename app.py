@@ -3,19 +3,37 @@ import random
 import logging
 import requests
 import json
+import math
+import atexit
+import bisect
+import csv
+import gzip
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import zlib
 
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
 from waitress import serve
 from apscheduler.schedulers.background import BackgroundScheduler
 from linebot.v3.messaging.exceptions import ApiException
 from datetime import datetime, timedelta
-from collections import defaultdict
+from urllib.parse import urlsplit
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from flask import Flask, request, abort, send_from_directory
-from linebot.v3 import WebhookHandler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from linebot.v3 import WebhookParser
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import *
 from linebot.v3.webhooks import (
+    FollowEvent,
+    UnfollowEvent,
     MessageEvent,
     TextMessageContent,
     LocationMessageContent
@@ -44,8 +62,50 @@ OLLAMA_TUNNEL_URL = os.getenv("OLLAMA_TUNNEL_URL", "")
 OLLAMA_TUNNEL_TOKEN = os.getenv("OLLAMA_TUNNEL_TOKEN", "")
 OLLAMA_TUNNEL_MODEL = os.getenv("OLLAMA_TUNNEL_MODEL", "qwen3:8b")
 
-# AI 來源偏好設定檔
+# 從收到 webhook 起算，超過這個秒數就停止生成並送出已產生的部分
+LLM_REPLY_DEADLINE = float(os.getenv("LLM_REPLY_DEADLINE", "45"))
+
+# 對沖請求（預設關閉）：主要後端遲遲沒有首個 token 時，同時詢問 LLM_HEDGE_SOURCE；
+# 每次觸發都會多付一次備援後端（例如 Groq）的費用，需要時再設定，例如 LLM_HEDGE_SOURCE=groq
+LLM_HEDGE_SOURCE = os.getenv("LLM_HEDGE_SOURCE", "")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "90"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "8"))
+LLM_HEDGE_MIN_SAMPLES = 5
+LLM_LATENCY_WINDOW = 50
+
+# 斷路器：連續失敗 LLM_CIRCUIT_FAILURES 次就暫停該後端 LLM_CIRCUIT_COOLDOWN 秒，改用下一個來源
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "3"))
+LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "60"))
+LLM_HEALTH_ALPHA = 0.2
+LLM_FAILOVER_ORDER = [s.strip() for s in os.getenv("LLM_FAILOVER_ORDER", "ollama_tunnel,groq,gemini").split(",") if s.strip()]
+LLM_FAILOVER_ATTEMPTS = int(os.getenv("LLM_FAILOVER_ATTEMPTS", "2"))
+
+# 每個後端的併發上限可用 LLM_CONCURRENCY_<來源> 覆寫，例如 LLM_CONCURRENCY_OLLAMA_TUNNEL=1
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+LLM_ENABLE_STUB = os.getenv("LLM_ENABLE_STUB", "0") == "1"
+LLM_STUB_DELAY = float(os.getenv("LLM_STUB_DELAY", "0.5"))
+LLM_STUB_CHAR_DELAY = float(os.getenv("LLM_STUB_CHAR_DELAY", "0.01"))
+
+# 提示長度預算（估算 token）可用 LLM_PROMPT_BUDGET_<來源> 覆寫；超出預算的舊對話改由背景濃縮成摘要
+# 摘要預設交給雲端後端，不佔用只有一個併發名額的 Ollama 通道；後端正忙時這次先不濃縮
+LLM_SUMMARY_ORDER = [s.strip() for s in os.getenv("LLM_SUMMARY_ORDER", "groq,gemini").split(",") if s.strip()]
+MEMORY_SUMMARY_CHARS = int(os.getenv("MEMORY_SUMMARY_CHARS", "200"))
+# 近期紀錄超出預算而要移動起點時，多空出的預算比例
+PROMPT_HISTORY_SLACK = 0.25
+# Ollama 模型與 KV 快取在閒置多久後才卸載
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# AI 來源偏好設定檔（僅供匯入，實際資料存於 STATE_DB）
 AI_SOURCE_FILE = "user_ai_source.json"
+STATE_DB = os.getenv("STATE_DB", "state.db")
+# 列在這裡的 JSON 檔（逗號分隔）下次啟動時以檔案內容覆蓋資料庫，例如 STATE_IMPORT_OVERRIDE=user_cities.json
+STATE_IMPORT_OVERRIDE = [s.strip() for s in os.getenv("STATE_IMPORT_OVERRIDE", "").split(",") if s.strip()]
+RESOURCE_CHECK_SECONDS = float(os.getenv("RESOURCE_CHECK_SECONDS", "2"))
+USAGE_LOG_FILE = "user_usage.log"
+USAGE_SNAPSHOT_SECONDS = int(os.getenv("USAGE_SNAPSHOT_SECONDS", "60"))
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "1"))
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "200"))
 AI_SOURCE_LABELS = {
     "groq": "☁️ Groq（雲端）",
     "gemini": "🔮 Gemini（雲端）",
@@ -56,18 +116,362 @@ AI_SOURCE_LABELS = {
 if not GROQ_API_KEY:
     raise ValueError("缺少 GROQ_API_KEY，請先在 Render 環境變數中設定！")
 
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "4"))
+# 等待處理的事件總數上限，超過就直接回罐頭訊息（reply_token 約一分鐘就失效，排太久也來不及回）
+EVENT_QUEUE_LIMIT = int(os.getenv("EVENT_QUEUE_LIMIT", str(EVENT_WORKERS * 8)))
+SHED_WORKERS = 2
+# 還沒送出的罐頭回覆上限；爆量時超過的直接不回，不讓 shed 佇列無限變長
+SHED_BACKLOG = SHED_WORKERS * 8
+# 以 webhookEventId 去除 LINE 重送的事件；EVENT_DEDUP_PERSIST=1 時另存進 state.db，重啟後仍有效
+EVENT_DEDUP_SECONDS = int(os.getenv("EVENT_DEDUP_SECONDS", "3600"))
+EVENT_DEDUP_SIZE = int(os.getenv("EVENT_DEDUP_SIZE", "20000"))
+EVENT_DEDUP_PERSIST = os.getenv("EVENT_DEDUP_PERSIST", "0") == "1"
+# AI 聊天的 token bucket：每位使用者可連發 AI_USER_BURST 則，之後每分鐘補 AI_USER_PER_MINUTE 則；全體另有總量上限
+AI_USER_BURST = float(os.getenv("AI_USER_BURST", "5"))
+AI_USER_PER_MINUTE = float(os.getenv("AI_USER_PER_MINUTE", "6"))
+AI_GLOBAL_BURST = float(os.getenv("AI_GLOBAL_BURST", "30"))
+AI_GLOBAL_PER_MINUTE = float(os.getenv("AI_GLOBAL_PER_MINUTE", "60"))
+AI_RATE_PERSIST = os.getenv("AI_RATE_PERSIST", "0") == "1"
+# LINE API 連線池大小：每個事件 worker 與罐頭回覆各一條，另外保留給排程任務
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", str(EVENT_WORKERS + SHED_WORKERS + 2)))
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "3600"))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "1000"))
+WEATHER_REFRESH_MINUTES = int(os.getenv("WEATHER_REFRESH_MINUTES", "30"))
+# 還沒有預報資料時，CWA 失敗後多久內不再重試
+WEATHER_RETRY_SECONDS = int(os.getenv("WEATHER_RETRY_SECONDS", "30"))
+POKEMON_INDEX_FILE = "pokemon_index.json"
+POKEMON_POOL_SIZE = int(os.getenv("POKEMON_POOL_SIZE", "5"))
+# 情緒按鈕的 AI 句子：離峰時段批次生成，每類保留 EMOTION_POOL_SIZE 句
+EMOTION_POOL_SIZE = int(os.getenv("EMOTION_POOL_SIZE", "30"))
+EMOTION_POOL_BATCH = int(os.getenv("EMOTION_POOL_BATCH", "10"))
+EMOTION_POOL_HOURS = os.getenv("EMOTION_POOL_HOURS", "3")
+
 scheduler = BackgroundScheduler(daemon=True)
+# 不影響回覆的背景工作（例如刷新快取）共用這個執行緒池
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="background")
+# 對沖請求時主要／備援後端各佔一條執行緒
+llm_executor = ThreadPoolExecutor(max_workers=EVENT_WORKERS * 2, thread_name_prefix="llm")
+# 對話摘要一次一個，不跟刷新快取搶 background_executor
+summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
 
 app = Flask(__name__)
 configuration = Configuration(access_token=LINE_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+configuration.connection_pool_maxsize = LINE_POOL_SIZE
+parser = WebhookParser(LINE_CHANNEL_SECRET)
 
 # 儲存最近一次 push 給每位使用者的時間
 last_push_time = {}
 
+# === 監控指標 ===
+# 行程內的計數器與直方圖，由 /metrics 以 Prometheus 文字格式輸出。
+# 記錄時只在該指標自己的鎖裡加幾個數字；佇列深度這類即時數值在抓取時才讀。
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRIC_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_metric_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] += amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for label_values, value in items:
+            yield "", self.labels, label_values, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=METRIC_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label 值 → [各區間（非累計）筆數, 總和]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *label_values):
+        return MetricTimer(self, label_values)
+
+    def samples(self):
+        with self.lock:
+            items = [(label_values, list(counts), total) for label_values, (counts, total) in self.series.items()]
+        for label_values, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield "_bucket", self.labels + ("le",), label_values + (le,), cumulative
+            yield "_sum", self.labels, label_values, total
+            yield "_count", self.labels, label_values, cumulative
+
+
+class MetricTimer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class CallbackMetric:
+    # 抓取時才呼叫 func；func 回傳單一數值，或 {label 值 tuple: 數值}
+    def __init__(self, name, help_text, labels, func, kind):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield "", self.labels, label_values, value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=METRIC_LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, func, labels=(), kind="gauge"):
+        return self._register(CallbackMetric(name, help_text, labels, func, kind))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for suffix, names, values, value in metric.samples():
+                    lines.append(f"{metric.name}{suffix}{format_metric_labels(names, values)} {float(value)!r}")
+            except Exception as e:
+                logging.warning(f"⚠️ 讀取指標 {metric.name} 失敗：{e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+webhook_seconds = metrics.histogram("webhook_request_seconds", "Time spent in /callback (verify, dedup, enqueue)")
+webhook_events_total = metrics.counter("webhook_events_total", "Webhook events by type and result", ("type", "result"))
+event_queue_wait_seconds = metrics.histogram("event_queue_wait_seconds", "Time events wait before a worker picks them up")
+event_handle_seconds = metrics.histogram("event_handle_seconds", "Event handler run time", ("handler",))
+line_profile_seconds = metrics.histogram("line_get_profile_seconds", "LINE get_profile latency")
+line_reply_total = metrics.counter("line_reply_total", "reply_message outcomes", ("outcome",))
+llm_request_seconds = metrics.histogram("llm_request_seconds", "LLM request time per provider", ("source",))
+llm_first_token_seconds = metrics.histogram("llm_first_token_seconds", "LLM time to first token per provider", ("source",))
+llm_queue_wait_seconds = metrics.histogram("llm_queue_wait_seconds", "Time LLM requests wait for a backend concurrency slot", ("source",))
+llm_requests_total = metrics.counter("llm_requests_total", "LLM requests per provider and outcome", ("source", "outcome"))
+cache_requests_total = metrics.counter("cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+scheduler_job_seconds = metrics.histogram("scheduler_job_seconds", "Scheduler job run time (from submission)", ("job",))
+scheduler_job_errors_total = metrics.counter("scheduler_job_errors_total", "Scheduler job failures", ("job",))
+
+# === LINE API 用戶端 ===
+# 整個程序共用一個 ApiClient／MessagingApi，webhook 處理與排程任務都重用同一組 keep-alive 連線。
+class LineClientHolder:
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.api_client = None
+        self.api = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.api is None:
+            with self.lock:
+                if self.api is None:
+                    self.api_client = ApiClient(self.configuration)
+                    self.api = MessagingApi(self.api_client)
+        return self.api
+
+    def close(self):
+        if self.api_client is not None:
+            self.api_client.close()
+
+
+line_client = LineClientHolder(configuration)
+atexit.register(line_client.close)
+
+
+class ProfileCache:
+    # user_id → display_name；過期的項目先回舊值，再交給背景執行緒向 LINE 刷新
+    def __init__(self, ttl, capacity):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def _fetch(self, user_id):
+        with line_profile_seconds.time():
+            display_name = line_client.get().get_profile(user_id).display_name
+        with self.lock:
+            self.entries[user_id] = (display_name, time.monotonic())
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return display_name
+
+    def _refresh(self, user_id):
+        try:
+            self._fetch(user_id)
+        except Exception as e:
+            logging.warning(f"⚠️ 刷新 {user_id} 的個人資料失敗，沿用快取：{e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(user_id)
+
+    def get_display_name(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry:
+                self.entries.move_to_end(user_id)
+        if entry is None:
+            cache_requests_total.inc("profile", "miss")
+            return self._fetch(user_id)
+
+        display_name, fetched_at = entry
+        if time.monotonic() - fetched_at > self.ttl:
+            cache_requests_total.inc("profile", "stale")
+            with self.lock:
+                stale = user_id not in self.refreshing
+                self.refreshing.add(user_id)
+            if stale:
+                background_executor.submit(self._refresh, user_id)
+        else:
+            cache_requests_total.inc("profile", "hit")
+        return display_name
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_TTL, PROFILE_CACHE_SIZE)
+
+
+# === 對外 HTTP 連線池 ===
+# 每個上游主機共用一個 keep-alive Session，避免每次呼叫都重新做 TCP/TLS 握手。
+# 只有 GET（冪等）會自動重試；LLM 的 POST 失敗就直接回報。
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_GET_RETRIES = int(os.getenv("HTTP_GET_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+
+def get_http_session(url):
+    host = urlsplit(url).netloc
+    session = http_sessions.get(host)
+    if session is None:
+        with http_sessions_lock:
+            session = http_sessions.get(host)
+            if session is None:
+                retry = Retry(
+                    total=HTTP_GET_RETRIES,
+                    backoff_factor=HTTP_RETRY_BACKOFF,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset(["GET"]),
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                http_sessions[host] = session
+    return session
+
+
+def http_get(url, timeout, **kwargs):
+    return get_http_session(url).get(url, timeout=(HTTP_CONNECT_TIMEOUT, timeout), **kwargs)
+
+
+def http_post(url, timeout, **kwargs):
+    return get_http_session(url).post(url, timeout=(HTTP_CONNECT_TIMEOUT, timeout), **kwargs)
+
+
+# === 背景寫回 ===
+class FlushTimer:
+    # 每 interval 秒呼叫一次 flush 的背景執行緒；跟 UsageRecorder 一樣第一次有資料要寫時才啟動，
+    # 不靠 start_scheduler()，用 flask run 或 gunicorn 啟動時也會定期寫回
+    def __init__(self, name, interval, flush):
+        self.name = name
+        self.interval = interval
+        self.flush = flush
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"❌ {self.name} 寫回失敗：{e}")
+
+
 # === 記憶系統 ===
 MEMORY_FOLDER = "user_log"
 MAX_HISTORY = 10
+MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", "500"))
+MEMORY_FLUSH_SECONDS = int(os.getenv("MEMORY_FLUSH_SECONDS", "10"))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(256 * 1024)))
 os.makedirs(MEMORY_FOLDER, exist_ok=True)
 
 
@@ -98,319 +502,1336 @@ def add_quick_reply(messages):
     return new_messages
 
 
-def append_user_message(user_id, role, content):
-    log_file = os.path.join(MEMORY_FOLDER, f"{user_id}.json")
-
-    try:
-        if os.path.exists(log_file):
-            with open(log_file, "r", encoding="utf-8") as f:
+def read_journal_tail(path, limit, block_size=4096):
+    # 從檔尾往回讀，只解析最後 limit 筆；寫到一半的壞行直接略過
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= limit:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+
+    records = []
+    for line in data.splitlines()[-limit:]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+class MemoryStore:
+    # 近期對話留在記憶體（LRU），新增的紀錄由背景執行緒批次附加到 user_log/<user_id>.jsonl
+    def __init__(self, folder, max_history, capacity, flush_seconds):
+        self.folder = folder
+        self.max_history = max_history
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.pending = {}
+        # 已從 pending 取出、正在寫進日誌的紀錄；重新載入時要補回，避免剛好讀到寫入前的檔案
+        self.unwritten = {}
+        self.loading = {}
+        self.summaries = {}
+        # user_id → {後端: 提示裡最舊那筆紀錄的時間戳}，跟快取的紀錄一起被 LRU 淘汰
+        self.anchors = {}
+        # 檔案 I/O 依 user_id 分散到多把鎖，不同使用者的讀寫互不等待；鎖的順序一律 io 鎖 → lock
+        self.lock = threading.Lock()
+        self.io_locks = [threading.Lock() for _ in range(64)]
+        self.flush_timer = FlushTimer("memory-flush", flush_seconds, self.flush)
+
+    def _path(self, user_id):
+        return os.path.join(self.folder, f"{user_id}.jsonl")
+
+    def _io_lock(self, user_id):
+        return self.io_locks[zlib.crc32(user_id.encode("utf-8")) % len(self.io_locks)]
+
+    def _summary_path(self, user_id):
+        return os.path.join(self.folder, f"{user_id}.summary.json")
+
+    def _migrate_legacy(self, user_id):
+        legacy_file = os.path.join(self.folder, f"{user_id}.json")
+        if not os.path.exists(legacy_file):
+            return
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
                 history = json.load(f)
-        else:
-            history = []
-    except Exception as e:
-        logging.warning(f"⚠️ 載入 {user_id} 的記憶失敗，將建立新紀錄：{e}")
-        history = []
-
-    history.append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now().isoformat()
-    })
-
-    history = history[-MAX_HISTORY:]
+            with open(self._path(user_id), "a", encoding="utf-8") as f:
+                for record in history:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(legacy_file, f"{legacy_file}.migrated")
+            logging.info(f"📦 已將 {user_id} 的記憶轉為 JSONL")
+        except Exception as e:
+            logging.warning(f"⚠️ 轉換 {user_id} 的舊記憶失敗：{e}")
 
-    try:
-        with open(log_file, "w", encoding="utf-8") as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.error(f"❌ 無法寫入 {user_id} 的記憶：{e}")
+    def _load(self, user_id):
+        # 讀檔與讀取 unwritten 都在同一把 io 鎖內完成，兩者一致：寫入中的紀錄不是已在檔案裡，就是還在 unwritten
+        log_file = self._path(user_id)
+        records = []
+        with self._io_lock(user_id):
+            try:
+                if not os.path.exists(log_file):
+                    self._migrate_legacy(user_id)
+                if os.path.exists(log_file):
+                    records = read_journal_tail(log_file, self.max_history)
+            except Exception as e:
+                logging.warning(f"⚠️ 載入 {user_id} 的記憶失敗，將建立新紀錄：{e}")
+            with self.lock:
+                unwritten = list(self.unwritten.get(user_id, []))
+        return (records + unwritten)[-self.max_history:]
 
+    def _append(self, user_id, records):
+        # 呼叫端需持有該使用者的 io 鎖
+        try:
+            data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+            with open(self._path(user_id), "ab+") as f:
+                # 上次寫到一半當機時先補上換行，避免新紀錄黏在壞行後面
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        data = b"\n" + data
+                f.write(data)
+        except Exception as e:
+            logging.error(f"❌ 無法寫入 {user_id} 的記憶：{e}")
+
+    def _take_pending(self, user_id):
+        # 呼叫端需持有 self.lock；把待寫紀錄移到 unwritten，直到真正寫進檔案
+        records = self.pending.pop(user_id)
+        self.unwritten.setdefault(user_id, []).extend(records)
+        return user_id, records
+
+    def _write(self, batches):
+        for user_id, records in batches:
+            with self._io_lock(user_id):
+                self._append(user_id, records)
+                with self.lock:
+                    written = {id(r) for r in records}
+                    remaining = [r for r in self.unwritten.get(user_id, []) if id(r) not in written]
+                    if remaining:
+                        self.unwritten[user_id] = remaining
+                    else:
+                        self.unwritten.pop(user_id, None)
+
+    def _ensure_loaded(self, user_id):
+        # 讀檔不持有全域鎖，冷門使用者的磁碟 I/O 不會卡住其他人；同一人同時只會載入一次
+        while True:
+            with self.lock:
+                if user_id in self.cache:
+                    cache_requests_total.inc("memory", "hit")
+                    return
+                loading = self.loading.get(user_id)
+                if loading is None:
+                    loading = self.loading[user_id] = threading.Event()
+                    break
+            loading.wait()
+
+        cache_requests_total.inc("memory", "miss")
+        evicted = []
+        try:
+            records = self._load(user_id)
+            with self.lock:
+                self.cache[user_id] = records
+                while len(self.cache) > self.capacity:
+                    old_id, _ = self.cache.popitem(last=False)
+                    self.summaries.pop(old_id, None)
+                    self.anchors.pop(old_id, None)
+                    if old_id in self.pending:
+                        evicted.append(self._take_pending(old_id))
+        finally:
+            with self.lock:
+                self.loading.pop(user_id).set()
+        self._write(evicted)
+
+    def get_history(self, user_id):
+        while True:
+            self._ensure_loaded(user_id)
+            with self.lock:
+                # 載入後到這裡之間可能又被擠出 LRU，那就重新載入
+                if user_id in self.cache:
+                    self.cache.move_to_end(user_id)
+                    return list(self.cache[user_id])
+
+    def get_anchor(self, user_id, source):
+        with self.lock:
+            return self.anchors.get(user_id, {}).get(source)
+
+    def set_anchor(self, user_id, source, timestamp):
+        with self.lock:
+            if user_id in self.cache:
+                self.anchors.setdefault(user_id, {})[source] = timestamp
+
+    def append_turn(self, user_id, user_content, assistant_content):
+        now = datetime.now().isoformat()
+        records = [
+            {"role": "user", "content": user_content, "timestamp": now},
+            {"role": "assistant", "content": assistant_content, "timestamp": now},
+        ]
+        while True:
+            self._ensure_loaded(user_id)
+            with self.lock:
+                if user_id not in self.cache:
+                    continue
+                self.cache.move_to_end(user_id)
+                history = self.cache[user_id]
+                history.extend(records)
+                del history[:-self.max_history]
+                self.pending.setdefault(user_id, []).extend(records)
+            self.flush_timer.start()
+            return
+
+    def get_summary(self, user_id):
+        # 摘要：{"content": 摘要文字, "until": 已濃縮到的最後一筆紀錄時間}
+        with self.lock:
+            if user_id in self.summaries:
+                return self.summaries[user_id]
+        summary = None
+        try:
+            with open(self._summary_path(user_id), "r", encoding="utf-8") as f:
+                summary = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"⚠️ 載入 {user_id} 的對話摘要失敗：{e}")
+        with self.lock:
+            self.summaries[user_id] = summary
+        return summary
+
+    def set_summary(self, user_id, content, until):
+        summary = {"content": content, "until": until, "updated": datetime.now().isoformat()}
+        path = self._summary_path(user_id)
+        try:
+            with self._io_lock(user_id):
+                with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                    json.dump(summary, f, ensure_ascii=False)
+                os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            logging.error(f"❌ 無法寫入 {user_id} 的對話摘要：{e}")
+            return
+        with self.lock:
+            self.summaries[user_id] = summary
+
+    def flush(self):
+        with self.lock:
+            pending = [self._take_pending(user_id) for user_id in list(self.pending)]
+        self._write(pending)
+        if pending:
+            logging.info(f"💾 已寫回 {len(pending)} 位使用者的記憶")
+
+    def compact(self):
+        # 日誌超過門檻時，把較舊的紀錄壓成 gzip 分段，使用中的日誌只留最近 max_history 筆
+        for file_name in os.listdir(self.folder):
+            if not file_name.endswith(".jsonl"):
+                continue
+            log_file = os.path.join(self.folder, file_name)
+            try:
+                if os.path.getsize(log_file) < JOURNAL_COMPACT_BYTES:
+                    continue
+                with self._io_lock(file_name[:-len(".jsonl")]):
+                    with open(log_file, "r", encoding="utf-8") as f:
+                        lines = [line for line in f if line.strip()]
+                    older, recent = lines[:-self.max_history], lines[-self.max_history:]
+                    if not older:
+                        continue
+
+                    stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+                    segment = f"{log_file[:-len('.jsonl')]}.{stamp}.jsonl.gz"
+                    with gzip.open(segment, "wt", encoding="utf-8") as f:
+                        f.writelines(older)
+
+                    tmp_file = f"{log_file}.tmp"
+                    with open(tmp_file, "w", encoding="utf-8") as f:
+                        f.writelines(recent)
+                    os.replace(tmp_file, log_file)
+                logging.info(f"🗜️ 壓縮 {file_name}：封存 {len(older)} 筆 → {os.path.basename(segment)}")
+            except Exception as e:
+                logging.error(f"❌ 壓縮記憶日誌 {file_name} 失敗：{e}")
+
+
+memory_store = MemoryStore(MEMORY_FOLDER, MAX_HISTORY, MEMORY_CACHE_SIZE, MEMORY_FLUSH_SECONDS)
+atexit.register(memory_store.flush)
+
+
+# === 狀態資料庫 ===
+# 使用者設定、城市、AI 來源、Groq 花費與排程訊息集中存放在 SQLite（WAL 模式），
+# 每條執行緒各自持有連線，寫入以單一交易完成，不再整檔讀改寫。
+class StateStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_cities (
+            name TEXT PRIMARY KEY,
+            city TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_ai_source (
+            user_id TEXT PRIMARY KEY,
+            source TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS groq_usage (
+            date TEXT PRIMARY KEY,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            total_cost REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS scheduled_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            time TEXT NOT NULL,
+            message TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_scheduled_messages_user ON scheduled_messages (user_id);
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            date TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            display_name TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            event_id TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self.conn() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get_meta(self, key, default=None):
+        row = self.conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.conn() as conn:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
 
-def build_prompt_with_memory(user_id):
-    log_file = os.path.join(MEMORY_FOLDER, f"{user_id}.json")
-    user_profiles = load_user_profiles()
-    profile = user_profiles.get(user_id, {})
+    # --- 使用者個人檔案 ---
+    def get_profile(self, user_id):
+        row = self.conn().execute("SELECT data FROM user_profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def load_profiles(self):
+        rows = self.conn().execute("SELECT user_id, data FROM user_profiles").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def save_profiles(self, profiles, replace=False):
+        # replace：整張表換成檔案內容（個人檔案只來自 user_profiles.json）
+        with self.conn() as conn:
+            if replace:
+                conn.execute("DELETE FROM user_profiles")
+            conn.executemany(
+                "INSERT INTO user_profiles (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                [(user_id, json.dumps(p, ensure_ascii=False)) for user_id, p in profiles.items()]
+            )
 
-    profile_text = "\n".join([f"{k}：{v}" for k, v in profile.items()])
-    profile_text = f"📇 使用者個人檔案：\n{profile_text}\n" if profile else ""
+    # --- 使用者城市 ---
+    def get_city(self, name):
+        row = self.conn().execute("SELECT city FROM user_cities WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def save_cities(self, cities, removed=(), keep_existing=False):
+        # removed：上次匯入的 JSON 有、這次已被刪掉的名字；keep_existing：只補資料庫還沒有的名字
+        with self.conn() as conn:
+            conn.executemany("DELETE FROM user_cities WHERE name = ?", [(k,) for k in removed])
+            conn.executemany(
+                "INSERT INTO user_cities (name, city) VALUES (?, ?) ON CONFLICT(name) "
+                + ("DO NOTHING" if keep_existing else "DO UPDATE SET city = excluded.city"),
+                list(cities.items())
+            )
 
-    history = []
-    if os.path.exists(log_file):
-        try:
-            with open(log_file, "r", encoding="utf-8") as f:
-                history = json.load(f)
-        except Exception:
-            pass
+    # --- AI 來源偏好 ---
+    def get_ai_source(self, user_id):
+        row = self.conn().execute("SELECT source FROM user_ai_source WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_ai_sources(self, sources, removed=(), keep_existing=False):
+        with self.conn() as conn:
+            conn.executemany("DELETE FROM user_ai_source WHERE user_id = ?", [(k,) for k in removed])
+            conn.executemany(
+                "INSERT INTO user_ai_source (user_id, source) VALUES (?, ?) ON CONFLICT(user_id) "
+                + ("DO NOTHING" if keep_existing else "DO UPDATE SET source = excluded.source"),
+                list(sources.items())
+            )
 
-    history_text = "\n".join([
-        f"{'你' if h['role'] == 'user' else BOT_NAME}：{h['content']}" for h in history
-    ])
-    return f"{profile_text}{history_text}"
+    # --- Groq 花費 ---
+    def add_groq_usage(self, date, total_tokens, cost):
+        with self.conn() as conn:
+            conn.execute(
+                "INSERT INTO groq_usage (date, total_tokens, total_cost) VALUES (?, ?, ?) "
+                "ON CONFLICT(date) DO UPDATE SET "
+                "total_tokens = total_tokens + excluded.total_tokens, "
+                "total_cost = total_cost + excluded.total_cost",
+                (date, total_tokens, cost)
+            )
 
+    def get_groq_usage(self, start_date, end_date=None):
+        row = self.conn().execute(
+            "SELECT COALESCE(SUM(total_tokens), 0), COALESCE(SUM(total_cost), 0.0) "
+            "FROM groq_usage WHERE date BETWEEN ? AND ?",
+            (start_date, end_date or start_date)
+        ).fetchone()
+        return row[0], row[1]
+
+    def replace_groq_usage(self, usage):
+        with self.conn() as conn:
+            conn.executemany(
+                "INSERT INTO groq_usage (date, total_tokens, total_cost) VALUES (?, ?, ?) "
+                "ON CONFLICT(date) DO UPDATE SET "
+                "total_tokens = excluded.total_tokens, total_cost = excluded.total_cost",
+                [(d, v.get("total_tokens", 0), v.get("total_cost", 0.0)) for d, v in usage.items()]
+            )
 
-def get_ollama_response(user_id, user_prompt):
-    try:
-        with open("system_prompt.txt", "r", encoding="utf-8") as f:
-            character_prompt = f.read().strip()
+    # --- 排程訊息 ---
+    def load_scheduled_messages(self):
+        rows = self.conn().execute("SELECT id, user_id, time, message FROM scheduled_messages ORDER BY id").fetchall()
+        return [{"id": r[0], "user_id": r[1], "time": r[2], "message": r[3]} for r in rows]
+
+    def replace_scheduled_messages(self, jobs):
+        with self.conn() as conn:
+            conn.execute("DELETE FROM scheduled_messages")
+            conn.executemany(
+                "INSERT INTO scheduled_messages (user_id, time, message) VALUES (?, ?, ?)",
+                [(j.get("user_id"), j.get("time"), j.get("message")) for j in jobs
+                 if j.get("user_id") and j.get("time") and j.get("message")]
+            )
 
-        history_prompt = build_prompt_with_memory(user_id)
-        full_prompt = f"{character_prompt}\n\n{history_prompt}\n你：{user_prompt}"
+    # --- 每日使用次數彙總 ---
+    def add_usage_counts(self, rows):
+        # rows: (date, user_id, display_name, 增加的次數)
+        with self.conn() as conn:
+            conn.executemany(
+                "INSERT INTO usage_daily (date, user_id, display_name, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(date, user_id) DO UPDATE SET "
+                "display_name = excluded.display_name, count = count + excluded.count",
+                rows
+            )
 
-        url = "http://59.124.237.254:49153/api/generate"
-        payload = {
-            "model": "gemma:2b",
-            "prompt": full_prompt,
-            "stream": False
+    def load_usage_rollup(self):
+        return self.conn().execute(
+            "SELECT date, user_id, display_name, count FROM usage_daily ORDER BY date"
+        ).fetchall()
+
+    def load_webhook_events(self, since):
+        return self.conn().execute(
+            "SELECT event_id, seen_at FROM webhook_events WHERE seen_at >= ? ORDER BY seen_at", (since,)
+        ).fetchall()
+
+    def has_webhook_event(self, event_id, since):
+        row = self.conn().execute(
+            "SELECT 1 FROM webhook_events WHERE event_id = ? AND seen_at >= ?", (event_id, since)
+        ).fetchone()
+        return row is not None
+
+    def add_webhook_events(self, rows, expire_before):
+        with self.conn() as conn:
+            conn.executemany("INSERT OR IGNORE INTO webhook_events (event_id, seen_at) VALUES (?, ?)", rows)
+            conn.execute("DELETE FROM webhook_events WHERE seen_at < ?", (expire_before,))
+
+    # --- 舊 JSON 檔匯入 ---
+    def _import_keyed(self, file_path, data, save, override):
+        # 城市與 AI 來源在執行中由聊天指令寫進資料庫，資料庫才是最新的：平常只補沒有的項目；
+        # 營運端用 STATE_IMPORT_OVERRIDE 指定時，檔案內容覆蓋資料庫，上次匯入有、這次被刪掉的項目也一併刪除。
+        meta_key = f"migrated_keys:{file_path}"
+        previous = set(json.loads(self.get_meta(meta_key, "[]")))
+        if override:
+            save(data, removed=sorted(previous - set(data)))
+            keys = set(data)
+        else:
+            save(data, keep_existing=True)
+            keys = previous | set(data)
+        self.set_meta(meta_key, json.dumps(sorted(keys), ensure_ascii=False))
+
+    def migrate_json_files(self, only=None, override=()):
+        # 每個檔案只在內容（mtime）變動過時匯入一次，營運端手動修改 JSON 後重啟即可生效。
+        # mtime 變了不代表檔案比資料庫新（重新部署也會變），所以城市與 AI 來源預設不覆蓋既有項目。
+        importers = {
+            "user_profiles.json": lambda data, forced: self.save_profiles(data, replace=True),
+            "user_cities.json": lambda data, forced: self._import_keyed(
+                "user_cities.json", data, self.save_cities, forced),
+            AI_SOURCE_FILE: lambda data, forced: self._import_keyed(
+                AI_SOURCE_FILE, data, self.save_ai_sources, forced),
+            "usage_summary.json": lambda data, forced: self.replace_groq_usage(data),
+            "schedule.json": lambda data, forced: self.replace_scheduled_messages(data),
         }
-        res = requests.post(
-            url,
-            headers={"Content-Type": "application/json"},
-            json=payload,
-            timeout=30
-        )
-        res_json = res.json()
-
-        if "response" in res_json:
+        for file_path, importer in importers.items():
+            if only and file_path not in only:
+                continue
+            if not os.path.exists(file_path):
+                continue
+            mtime = str(os.path.getmtime(file_path))
+            forced = file_path in override
+            # 覆蓋匯入另外記一次，同一份檔案不會在每次重啟時反覆覆蓋
+            meta_key = f"{'override' if forced else 'migrated'}:{file_path}"
+            if self.get_meta(meta_key) == mtime:
+                continue
             try:
-                reply = res_json["response"].strip()
-                if not reply:
-                    raise ValueError("空回應")
-                append_user_message(user_id, "user", user_prompt)
-                append_user_message(user_id, "assistant", reply)
-                return reply
+                with open(file_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                importer(data, forced)
+                self.set_meta(meta_key, mtime)
+                if forced:
+                    self.set_meta(f"migrated:{file_path}", mtime)
+                logging.info(f"📦 已匯入 {file_path} 至 {self.db_path}")
             except Exception as e:
-                logging.warning(f"Ollama 回應格式錯誤或內容缺失：{e}")
-                reply = "😅 抱歉，皮 想不出話來...可以再問一次嗎？"
-                append_user_message(user_id, "user", user_prompt)
-                append_user_message(user_id, "assistant", reply)
-                return reply
-        elif "error" in res_json:
-            logging.error(f"Ollama 回傳錯誤：{res_json}")
-            return f"⚠️ Ollama 錯誤：{res_json['error']}"
-        else:
-            logging.error(f"Ollama 回傳未知格式：{res_json}")
-            return "❌ 無法取得 LLM 回覆，請稍後再試。"
-    except Exception as e:
-        logging.error("Ollama 回應失敗: %s", str(e))
-        return "❌ 無法取得 LLM 回覆，請稍後再試。"
+                logging.error(f"❌ 匯入 {file_path} 失敗：{e}")
 
 
-def get_gemini_response(user_id, user_prompt):
-    try:
-        with open("system_prompt.txt", "r", encoding="utf-8") as f:
-            character_prompt = f.read().strip()
+state_store = StateStore(STATE_DB)
+state_store.migrate_json_files(override=STATE_IMPORT_OVERRIDE)
 
-        history_prompt = build_prompt_with_memory(user_id)
-        full_prompt = f"{character_prompt}\n\n{history_prompt}\n你：{user_prompt}"
 
-        url = f"https://generativelanguage.googleapis.com/v1/models/gemini-2.5-flash-lite:generateContent?key={GEMINI_API_KEY}"
-        res = requests.post(
-            url,
-            headers={"Content-Type": "application/json"},
-            json={"contents": [{"parts": [{"text": full_prompt}]}]},
-            timeout=30
-        )
-        res_json = res.json()
+# === 資源檔快取 ===
+# 人設、語錄、圖片清單等檔案解析一次後留在記憶體，
+# 每 RESOURCE_CHECK_SECONDS 秒最多檢查一次 mtime，檔案被修改就重新載入。
+class ResourceCache:
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.entries = {}
+        self.lock = threading.Lock()
 
-        if "candidates" in res_json:
-            try:
-                reply = res_json["candidates"][0]["content"]["parts"][0]["text"].strip()
-                if not reply:
-                    raise ValueError("空回應")
-                append_user_message(user_id, "user", user_prompt)
-                append_user_message(user_id, "assistant", reply)
-                return reply
-            except Exception as e:
-                logging.warning(f"Gemini 回應格式錯誤或內容缺失：{e}")
-                reply = "😅 抱歉，皮 想不出話來...可以再問一次嗎？"
-                append_user_message(user_id, "user", user_prompt)
-                append_user_message(user_id, "assistant", reply)
-                return reply
-        elif "error" in res_json:
-            logging.error(f"Gemini 回傳錯誤：{res_json}")
-            return f"⚠️ Gemini 錯誤：{res_json['error'].get('message', '未知錯誤')}"
-        else:
-            logging.error(f"Gemini 回傳未知格式：{res_json}")
-            return "❌ 無法取得 Gemini 回覆，請稍後再試。"
-    except Exception as e:
-        logging.error("Gemini 回應失敗: %s", str(e))
-        return "❌ 無法取得 Gemini 回覆，請稍後再試。"
+    def get(self, file_path, loader):
+        now = time.monotonic()
+        entry = self.entries.get(file_path)
+        if entry and now - entry["checked_at"] < self.check_interval:
+            cache_requests_total.inc("resource", "hit")
+            return entry["value"]
 
+        mtime = os.path.getmtime(file_path)
+        if entry and entry["mtime"] == mtime:
+            entry["checked_at"] = now
+            cache_requests_total.inc("resource", "hit")
+            return entry["value"]
+        cache_requests_total.inc("resource", "load")
 
-def log_daily_groq_cost_to_json(model, total_tokens):
-    model_prices = {
-        "llama3-8b-8192": 0.13,
-        "llama3-70b-8192": 1.38,
-        "llama-3.3-70b-versatile": 0.5,
-        "mixtral-8x7b-32768": 0.6,
-        "gemma-7b-it": 0.4
-    }
-    cost_per_million = model_prices.get(model, 0.5)
-    cost = (total_tokens / 1_000_000) * cost_per_million
-    today = datetime.now().strftime("%Y-%m-%d")
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry and entry["mtime"] == mtime:
+                return entry["value"]
+            value = loader(file_path)
+            self.entries[file_path] = {"mtime": mtime, "value": value, "checked_at": now}
+            if entry:
+                logging.info(f"🔄 重新載入 {file_path}")
+        return value
 
-    try:
-        with open("usage_summary.json", "r", encoding="utf-8") as f:
-            usage = json.load(f)
-    except FileNotFoundError:
-        usage = {}
 
-    if today not in usage:
-        usage[today] = {"total_tokens": 0, "total_cost": 0.0}
+def read_text_file(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        return f.read().strip()
 
-    usage[today]["total_tokens"] += total_tokens
-    usage[today]["total_cost"] += cost
 
-    with open("usage_summary.json", "w", encoding="utf-8") as f:
-        json.dump(usage, f, ensure_ascii=False, indent=2)
+def read_json_file(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-    return cost
+
+def read_lines_file(file_path):
+    with open(file_path, "r", encoding="utf-8-sig") as f:
+        return [line.strip() for line in f if line.strip()]
 
 
-def get_groq_response(user_id, user_prompt, model=DEFAULT_GROQ_MODEL):
+resource_cache = ResourceCache(RESOURCE_CHECK_SECONDS)
+
+
+def load_system_prompt():
+    return resource_cache.get("system_prompt.txt", read_text_file)
+
+
+def refresh_user_profiles():
+    # user_profiles.json 被手動修改時，重新匯入狀態資料庫
     try:
-        api_key = GROQ_API_KEY
-        if not api_key:
-            logging.error("❌ 無法載入 Groq API 金鑰")
-            return "❌ Groq API 金鑰未設定"
+        resource_cache.get("user_profiles.json", lambda path: state_store.migrate_json_files([path]))
+    except OSError:
+        pass
 
-        with open("system_prompt.txt", "r", encoding="utf-8") as f:
-            character_prompt = f.read().strip()
 
-        history_prompt = build_prompt_with_memory(user_id)
+def get_user_profile(user_id):
+    refresh_user_profiles()
+    return state_store.get_profile(user_id)
 
-        messages = [
-            {"role": "system", "content": character_prompt},
-            {"role": "user", "content": f"{history_prompt}\n你：{user_prompt}"}
-        ]
 
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+def estimate_tokens(text):
+    # 粗估：中日韓文字約一字一 token，其他約四個字元一 token，只用來控制提示長度
+    wide = sum(1 for ch in text if ch >= "\u2e80")
+    return wide + (len(text) - wide) // 4 + 1
 
-        data = {
-            "model": model,
-            "messages": messages
-        }
 
-        url = "https://api.groq.com/openai/v1/chat/completions"
-        res = requests.post(url, headers=headers, json=data, timeout=30)
-        res_json = res.json()
+def format_history_line(record):
+    return f"{'你' if record['role'] == 'user' else BOT_NAME}：{record['content']}"
 
-        if "choices" in res_json:
-            try:
-                reply = res_json["choices"][0]["message"]["content"].strip()
-            except Exception:
-                logging.error(f"Groq 回傳異常：{res_json}")
-                return "❌ Groq 回應異常"
 
-            usage = res_json.get("usage", {})
-            total_tokens = usage.get("total_tokens", 0)
+def history_fit_start(history, remaining):
+    # 從最新往回放，回傳放得進 remaining 的最早索引
+    start = len(history)
+    while start > 0 and estimate_tokens(format_history_line(history[start - 1])) <= remaining:
+        start -= 1
+        remaining -= estimate_tokens(format_history_line(history[start]))
+    return start
 
-            append_user_message(user_id, "user", user_prompt)
-            append_user_message(user_id, "assistant", reply)
-            log_daily_groq_cost_to_json(model, total_tokens)
 
-            return reply
+def build_prompt_with_memory(user_id, budget=None, source=None):
+    # 回傳 (個人檔案文字, 摘要文字, 放進提示的近期紀錄, 移出提示的舊紀錄)；已濃縮進摘要的紀錄不再重複放入。
+    # 近期紀錄從這個後端上次的起點放到最新，前綴才會連續幾輪不變；起點被 MAX_HISTORY 擠掉時從現存最舊一筆開始，
+    # 放不進預算時才往後移，並多空出 PROMPT_HISTORY_SLACK 的預算，接下來幾輪不必每輪再移一筆。
+    profile = get_user_profile(user_id)
 
-        elif "error" in res_json:
-            logging.error(f"Groq 回傳錯誤：{res_json}")
-            return f"⚠️ Groq 錯誤：{res_json['error'].get('message', '未知錯誤')}"
-        else:
-            logging.error(f"Groq 回傳未知格式：{res_json}")
-            return "❌ 無法取得 Groq 回覆，請稍後再試。"
+    profile_text = "\n".join([f"{k}：{v}" for k, v in profile.items()])
+    profile_text = f"📇 使用者個人檔案：\n{profile_text}" if profile else ""
+
+    history = memory_store.get_history(user_id)
+    summary = memory_store.get_summary(user_id)
+    summary_text = ""
+    if summary:
+        summary_text = f"📝 先前對話摘要：{summary['content']}"
+        history = [h for h in history if h.get("timestamp", "") > summary["until"]]
+
+    start = 0
+    anchor = memory_store.get_anchor(user_id, source)
+    if anchor:
+        start = next((i for i, h in enumerate(history) if h.get("timestamp", "") >= anchor), len(history))
+    if budget is not None:
+        remaining = budget - estimate_tokens(profile_text) - estimate_tokens(summary_text)
+        if history_fit_start(history, remaining) > start:
+            start = history_fit_start(history, int(remaining * (1 - PROMPT_HISTORY_SLACK)))
+            # 從一輪的開頭（user 紀錄）切，不留落單的 assistant 回覆
+            while start < len(history) and history[start]["role"] != "user":
+                start += 1
+    if start < len(history):
+        memory_store.set_anchor(user_id, source, history[start].get("timestamp", ""))
+    return profile_text, summary_text, history[start:], history[:start]
+
+
+class MemorySummarizer:
+    # 放不進提示預算的舊對話先記下來，等回覆送出後才在背景濃縮成每位使用者一份滾動摘要，
+    # 避免摘要請求跟使用者的回覆搶同一個後端。
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.overflow = {}
+        self.running = set()
+        self.lock = threading.Lock()
+
+    def note(self, user_id, records):
+        if not user_id or not records:
+            return
+        with self.lock:
+            if len(records) > len(self.overflow.get(user_id, [])):
+                self.overflow[user_id] = records
+
+    def kick(self, user_id):
+        with self.lock:
+            if user_id not in self.overflow or user_id in self.running:
+                return
+            self.running.add(user_id)
+            records = self.overflow.pop(user_id)
+        summary_executor.submit(self._summarize, user_id, records)
+
+    def _summarize(self, user_id, records):
+        try:
+            summary = memory_store.get_summary(user_id)
+            if summary:
+                records = [r for r in records if r.get("timestamp", "") > summary["until"]]
+            if not records:
+                return
+            dialogue = "\n".join(format_history_line(r) for r in records)
+            request = (
+                f"請把以下對話濃縮成 {self.max_chars} 字以內的繁體中文摘要，"
+                "保留使用者提到的重要事實、偏好與約定，只輸出摘要本身。\n"
+                f"舊摘要：{summary['content'] if summary else '（無）'}\n"
+                f"新對話：\n{dialogue}"
+            )
+            content = generate_offline_reply(
+                request, LLM_SUMMARY_ORDER, system="你是負責整理對話紀錄的助理。", idle_only=True
+            )
+            if not content:
+                # 後端忙碌或失敗：放回去，下一次回覆送出後再試
+                self.note(user_id, records)
+                logging.warning(f"⚠️ {user_id} 的對話摘要這次沒有生成，下次再試")
+                return
+            memory_store.set_summary(user_id, content.strip()[:self.max_chars * 2], records[-1].get("timestamp", ""))
+            logging.info(f"📝 更新 {user_id} 的對話摘要（濃縮 {len(records)} 筆）")
+        except Exception as e:
+            logging.error(f"❌ 濃縮 {user_id} 的對話失敗：{e}")
+        finally:
+            with self.lock:
+                self.running.discard(user_id)
+
+
+memory_summarizer = MemorySummarizer(MEMORY_SUMMARY_CHARS)
+
+
+# === LLM 串流 ===
+# 所有後端都以串流方式接收回覆；期限（事件抵達時間 + LLM_REPLY_DEADLINE）快到時
+# 就停止生成，先把已經產生的部分回給使用者，避免 reply_token 過期整段回覆遺失。
+def get_reply_deadline(received_at):
+    return received_at + LLM_REPLY_DEADLINE if received_at else None
+
+
+def llm_read_timeout(default, deadline):
+    if not deadline:
+        return default
+    return max(1.0, min(default, deadline - time.time()))
+
+
+def iter_ndjson(res):
+    for line in res.iter_lines():
+        if line:
+            yield json.loads(line)
+
+
+def iter_sse(res):
+    for line in res.iter_lines():
+        line = line.decode("utf-8")
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        yield json.loads(data)
+
+
+class LLMCall:
+    # 單次 LLM 呼叫的控制狀態：期限、取消旗標、首個 token 與是否寫入記憶
+    def __init__(self, source, deadline=None, remember=True):
+        self.source = source
+        self.deadline = deadline
+        self.remember = remember
+        self.started_at = time.monotonic()
+        self.ok = False
+        self.usage = {}
+        # 排隊逾時沒拿到併發名額，不算後端故障
+        self.rejected = False
+        self.first_token = threading.Event()
+        self.progress = threading.Event()
+        self.cancelled = threading.Event()
+        self.expired = threading.Event()
+        self.response = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def mark_first_token(self):
+        llm_latency.record(self.source, time.monotonic() - self.started_at)
+        llm_first_token_seconds.observe(time.monotonic() - self.started_at, self.source)
+        self.first_token.set()
+        self.progress.set()
+
+    def attach(self, res):
+        # 串流開始後記住連線；期限一到由計時器直接關掉連線，不必等下一段資料（read timeout 是每次讀取各自計算，擋不住中途停住的串流）
+        with self.lock:
+            self.response = res
+        if self.cancelled.is_set():
+            # 還在等回應標頭時就被取消了
+            self.close()
+        elif self.deadline:
+            self.timer = threading.Timer(max(0, self.deadline - time.time()), self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def detach(self):
+        with self.lock:
+            self.response = None
+        if self.timer:
+            self.timer.cancel()
+
+    def close(self):
+        # 另一條執行緒可能正卡在 recv，先 shutdown socket 讓它立刻醒來
+        with self.lock:
+            res = self.response
+        if res is None:
+            return
+        try:
+            sock = getattr(res.raw.connection, "sock", None)
+            if sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        res.close()
 
-    except Exception as e:
-        logging.error("Groq 回應失敗: %s", str(e))
-        return "❌ 無法取得 Groq 回覆，請稍後再試。"
+    def expire(self):
+        self.expired.set()
+        self.close()
 
+    def cancel(self):
+        # 直接關掉連線：上游停止生成，卡在讀取的執行緒立刻結束並釋放後端的併發名額
+        self.cancelled.set()
+        self.close()
 
-def load_user_ai_source():
-    try:
-        with open(AI_SOURCE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
 
+class LatencyTracker:
+    # 各後端最近的首個 token 延遲，用來決定何時發出對沖請求
+    def __init__(self, window):
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
 
-def save_user_ai_source(user_id, source):
-    data = load_user_ai_source()
-    data[user_id] = source
-    with open(AI_SOURCE_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    def record(self, source, seconds):
+        with self.lock:
+            self.samples[source].append(seconds)
 
+    def percentile(self, source, pct):
+        with self.lock:
+            samples = sorted(self.samples[source])
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * pct / 100))
+        return samples[index]
 
-def get_user_ai_source(user_id):
-    return load_user_ai_source().get(user_id, DEFAULT_AI_SOURCE)
 
+llm_latency = LatencyTracker(LLM_LATENCY_WINDOW)
 
-def get_ollama_tunnel_response(user_id, user_prompt):
+
+def collect_stream(chunks, call):
+    # 回傳 (回覆內容, 是否提早停止)；提早停止可能是期限到了或被取消
+    parts = []
     try:
-        with open("system_prompt.txt", "r", encoding="utf-8") as f:
-            character_prompt = f.read().strip()
+        for text in chunks:
+            if text:
+                if not parts:
+                    call.mark_first_token()
+                parts.append(text)
+            if call.cancelled.is_set():
+                return "".join(parts).strip(), True
+            if call.deadline and parts and time.time() >= call.deadline:
+                return "".join(parts).strip(), True
+    except Exception as e:
+        if call.cancelled.is_set():
+            return "".join(parts).strip(), True
+        if call.expired.is_set():
+            # 期限計時器關掉了連線：有內容就先回，沒有就當逾時
+            if parts:
+                return "".join(parts).strip(), True
+            raise requests.exceptions.Timeout("reply deadline reached")
+        if not isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            raise
+        # 串流讀取逾時時 requests 會包成 ConnectionError，這裡統一當成逾時處理
+        if "timed out" not in str(e) and not isinstance(e, requests.exceptions.Timeout):
+            raise
+        if call.deadline and parts and time.time() >= call.deadline - 1:
+            return "".join(parts).strip(), True
+        raise requests.exceptions.Timeout(str(e))
+    return "".join(parts).strip(), False
+
+
+def finish_reply(user_id, user_prompt, reply, call, truncated):
+    if truncated:
+        logging.warning(f"⏱️ 接近 reply_token 期限，截斷 {user_id} 的回覆（{len(reply)} 字）")
+        reply = f"{reply}…"
+    call.ok = True
+    if call.remember:
+        memory_store.append_turn(user_id, user_prompt, reply)
+    return reply
+
+
+def log_daily_groq_cost(model, total_tokens):
+    model_prices = {
+        "llama3-8b-8192": 0.13,
+        "llama3-70b-8192": 1.38,
+        "llama-3.3-70b-versatile": 0.5,
+        "mixtral-8x7b-32768": 0.6,
+        "gemma-7b-it": 0.4
+    }
+    cost_per_million = model_prices.get(model, 0.5)
+    cost = (total_tokens / 1_000_000) * cost_per_million
+    today = datetime.now().strftime("%Y-%m-%d")
+    state_store.add_groq_usage(today, total_tokens, cost)
+
+    return cost
 
-        history_prompt = build_prompt_with_memory(user_id)
 
-        url = f"{OLLAMA_TUNNEL_URL}/api/chat"
+def save_user_ai_source(user_id, source):
+    state_store.save_ai_sources({user_id: source})
+
+
+def get_user_ai_source(user_id):
+    return state_store.get_ai_source(user_id) or DEFAULT_AI_SOURCE
+
+
+# === LLM 後端 ===
+# 共用流程（組提示、併發限制、串流收集、寫入記憶）在 run_backend；
+# 每個後端只實作 stream()：送出請求並逐段 yield 文字，API 回報的錯誤以 LLMBackendError 拋出。
+class LLMBackendError(Exception):
+    pass
+
+
+class LLMPrompt:
+    def __init__(self, system, profile, summary, history, user):
+        self.system = system
+        self.profile = profile
+        self.summary = summary
+        self.history = history
+        self.user = user
+
+    def as_text(self):
+        background = "".join(f"{text}\n" for text in (self.profile, self.summary) if text)
+        history_text = "\n".join(format_history_line(h) for h in self.history)
+        return f"{self.system}\n\n{background}{history_text}\n你：{self.user}"
+
+    def as_messages(self):
+        # 依固定順序排：角色設定與個人檔案 → 逐輪 user/assistant → 摘要 → 新訊息。
+        # 會變動的摘要放在舊對話之後，前面的訊息每輪都一樣，伺服器的 prefix/KV 快取才能沿用。
+        system = f"{self.system}\n\n{self.profile}" if self.profile else self.system
+        messages = [{"role": "system", "content": system}]
+        history = [h for h in self.history if h["role"] in ("user", "assistant")]
+        if history and history[0]["role"] == "assistant":
+            history = history[1:]
+        messages.extend({"role": h["role"], "content": h["content"]} for h in history)
+        if self.summary:
+            messages.append({"role": "system", "content": self.summary})
+        messages.append({"role": "user", "content": self.user})
+        return messages
+
+
+def build_llm_prompt(user_id, user_prompt, budget, source=None):
+    system = load_system_prompt()
+    profile, summary, history, overflow = build_prompt_with_memory(
+        user_id, budget - estimate_tokens(system) - estimate_tokens(user_prompt), source
+    )
+    memory_summarizer.note(user_id, overflow)
+    return LLMPrompt(system, profile, summary, history, user_prompt)
+
+
+class LLMBackend:
+    name = ""
+    display_name = ""
+    read_timeout = 30
+    default_concurrency = 4
+    default_prompt_budget = 2000
+    # 空回應時改用的句子；None 代表空回應視為失敗
+    empty_reply = "😅 抱歉，皮 想不出話來...可以再問一次嗎？"
+    timeout_message = None
+
+    def __init__(self):
+        self.concurrency = int(os.getenv(f"LLM_CONCURRENCY_{self.name.upper()}", str(self.default_concurrency)))
+        self.semaphore = threading.BoundedSemaphore(self.concurrency)
+        self.prompt_budget = int(os.getenv(f"LLM_PROMPT_BUDGET_{self.name.upper()}", str(self.default_prompt_budget)))
+        self.waiting = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def stream(self, prompt, call):
+        raise NotImplementedError
+
+    def after_reply(self, call):
+        pass
+
+    def acquire(self, call):
+        queued_at = time.monotonic()
+        with self.lock:
+            self.waiting += 1
+        acquired = self.semaphore.acquire(timeout=llm_read_timeout(LLM_QUEUE_TIMEOUT, call.deadline))
+        waited = time.monotonic() - queued_at
+        with self.lock:
+            self.waiting -= 1
+            if acquired:
+                self.in_flight += 1
+        llm_queue_wait_seconds.observe(waited, self.name)
+        if waited > 1:
+            logging.warning(f"🚦 {self.name} 排隊 {waited:.1f} 秒（上限 {self.concurrency} 併發）")
+        return acquired
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.semaphore.release()
+
+
+class OllamaGenerateBackend(LLMBackend):
+    name = "ollama"
+    display_name = "Ollama"
+    default_concurrency = 1
+    default_prompt_budget = 1200
+    url = "http://59.124.237.254:49153/api/generate"
+    model = "gemma:2b"
+
+    def stream(self, prompt, call):
+        payload = {
+            "model": self.model,
+            "prompt": prompt.as_text(),
+            "stream": True,
+            "keep_alive": OLLAMA_KEEP_ALIVE
+        }
+        with http_post(
+            self.url,
+            headers={"Content-Type": "application/json"},
+            json=payload,
+            timeout=llm_read_timeout(self.read_timeout, call.deadline),
+            stream=True
+        ) as res:
+            call.attach(res)
+            if res.status_code != 200:
+                raise LLMBackendError(res.json().get("error", res.status_code))
+            for data in iter_ndjson(res):
+                if "error" in data:
+                    raise LLMBackendError(data["error"])
+                yield data.get("response", "")
+
+
+class OllamaTunnelBackend(LLMBackend):
+    name = "ollama_tunnel"
+    display_name = "Ollama Tunnel"
+    read_timeout = 120
+    default_concurrency = 1
+    default_prompt_budget = 1600
+    empty_reply = None
+    timeout_message = "⏱️ Ollama 回應太慢，請再試一次或輸入「切換AI groq」改用雲端。"
+
+    def stream(self, prompt, call):
         headers = {
             "Content-Type": "application/json",
             "X-LT-Token": OLLAMA_TUNNEL_TOKEN,
         }
         payload = {
             "model": OLLAMA_TUNNEL_MODEL,
-            "messages": [
-                {"role": "system", "content": character_prompt},
-                {"role": "user", "content": f"{history_prompt}\n你：{user_prompt}"},
-            ],
-            "stream": False,
+            "messages": prompt.as_messages(),
+            "stream": True,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
         }
-        res = requests.post(url, headers=headers, json=payload, timeout=120)
-        res_json = res.json()
-
-        reply = res_json.get("message", {}).get("content", "").strip()
-        if not reply:
-            raise ValueError(f"空回應：{res_json}")
-
-        append_user_message(user_id, "user", user_prompt)
-        append_user_message(user_id, "assistant", reply)
-        return reply
+        with http_post(
+            f"{OLLAMA_TUNNEL_URL}/api/chat",
+            headers=headers,
+            json=payload,
+            timeout=llm_read_timeout(self.read_timeout, call.deadline),
+            stream=True
+        ) as res:
+            call.attach(res)
+            if res.status_code != 200:
+                raise LLMBackendError(f"HTTP {res.status_code}：{res.text[:200]}")
+            for data in iter_ndjson(res):
+                if "error" in data:
+                    raise LLMBackendError(data["error"])
+                yield data.get("message", {}).get("content", "")
+
+
+class GroqBackend(LLMBackend):
+    name = "groq"
+    display_name = "Groq"
+    default_concurrency = 8
+    default_prompt_budget = 4000
+    empty_reply = None
+    url = "https://api.groq.com/openai/v1/chat/completions"
+
+    def __init__(self, model=DEFAULT_GROQ_MODEL):
+        super().__init__()
+        self.model = model
+
+    def stream(self, prompt, call):
+        if not GROQ_API_KEY:
+            raise LLMBackendError("Groq API 金鑰未設定")
 
+        headers = {
+            "Authorization": f"Bearer {GROQ_API_KEY}",
+            "Content-Type": "application/json"
+        }
+        data = {
+            "model": self.model,
+            "messages": prompt.as_messages(),
+            "stream": True
+        }
+        with http_post(
+            self.url,
+            headers=headers,
+            json=data,
+            timeout=llm_read_timeout(self.read_timeout, call.deadline),
+            stream=True
+        ) as res:
+            call.attach(res)
+            if res.status_code != 200:
+                raise LLMBackendError(res.json().get("error", {}).get("message", "未知錯誤"))
+            for chunk in iter_sse(res):
+                call.usage.update(chunk.get("usage") or chunk.get("x_groq", {}).get("usage") or {})
+                for choice in chunk.get("choices", [])[:1]:
+                    yield choice.get("delta", {}).get("content") or ""
+
+    def after_reply(self, call):
+        log_daily_groq_cost(self.model, call.usage.get("total_tokens", 0))
+
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+    display_name = "Gemini"
+    default_concurrency = 8
+    default_prompt_budget = 4000
+    model = "gemini-2.5-flash-lite"
+
+    def stream(self, prompt, call):
+        url = f"https://generativelanguage.googleapis.com/v1/models/{self.model}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+        with http_post(
+            url,
+            headers={"Content-Type": "application/json"},
+            json={"contents": [{"parts": [{"text": prompt.as_text()}]}]},
+            timeout=llm_read_timeout(self.read_timeout, call.deadline),
+            stream=True
+        ) as res:
+            call.attach(res)
+            if res.status_code != 200:
+                raise LLMBackendError(res.json().get("error", {}).get("message", "未知錯誤"))
+            for data in iter_sse(res):
+                for candidate in data.get("candidates", [])[:1]:
+                    for part in candidate.get("content", {}).get("parts", []):
+                        yield part.get("text", "")
+
+
+class StubBackend(LLMBackend):
+    # 壓力測試用：不連網，固定延遲後逐字吐出可預期的回覆
+    name = "stub"
+    display_name = "Stub"
+    default_concurrency = 64
+
+    def stream(self, prompt, call):
+        time.sleep(LLM_STUB_DELAY)
+        for char in f"{BOT_NAME}收到：{prompt.user}":
+            time.sleep(LLM_STUB_CHAR_DELAY)
+            yield char
+
+
+AI_BACKENDS = {}
+
+
+def register_backend(backend):
+    AI_BACKENDS[backend.name] = backend
+    return backend
+
+
+register_backend(GroqBackend())
+register_backend(OllamaGenerateBackend())
+register_backend(GeminiBackend())
+register_backend(OllamaTunnelBackend())
+if LLM_ENABLE_STUB:
+    register_backend(StubBackend())
+    AI_SOURCE_LABELS["stub"] = "🧪 本地測試 Stub"
+
+
+def run_backend(backend, user_id, user_prompt, call, prompt=None):
+    generic_error = f"❌ 無法取得 {backend.display_name} 回覆，請稍後再試。"
+    if not backend.acquire(call):
+        call.rejected = True
+        return f"🚦 {backend.display_name} 忙碌中，請稍後再試。"
+    try:
+        prompt = prompt or build_llm_prompt(user_id, user_prompt, backend.prompt_budget, backend.name)
+        stream = backend.stream(prompt, call)
+        try:
+            reply, truncated = collect_stream(stream, call)
+        finally:
+            stream.close()
+            call.detach()
+    except LLMBackendError as e:
+        logging.error(f"{backend.display_name} 回傳錯誤：{e}")
+        return f"⚠️ {backend.display_name} 錯誤：{e}"
     except requests.exceptions.Timeout:
-        logging.error("Ollama Tunnel 逾時")
-        return "⏱️ Ollama 回應太慢，請再試一次或輸入「切換AI groq」改用雲端。"
+        logging.error(f"{backend.display_name} 逾時")
+        return backend.timeout_message or generic_error
     except Exception as e:
-        logging.error("Ollama Tunnel 回應失敗: %s", str(e))
-        return "❌ 無法取得 Ollama Tunnel 回覆，請稍後再試。"
-
-
-def get_ai_response(user_id, user_prompt, source=None):
+        logging.error("%s 回應失敗: %s", backend.display_name, str(e))
+        return generic_error
+    finally:
+        backend.release()
+
+    if call.cancelled.is_set():
+        return ""
+    if not reply:
+        if backend.empty_reply is None:
+            logging.error(f"{backend.display_name} 回傳異常：空回應")
+            return generic_error
+        logging.warning(f"{backend.display_name} 回應格式錯誤或內容缺失：空回應")
+        reply = backend.empty_reply
+
+    reply = finish_reply(user_id, user_prompt, reply, call, truncated)
+    backend.after_reply(call)
+    return reply
+
+
+class ProviderHealth:
+    # 各後端的延遲與錯誤率 EWMA；連續失敗達門檻就斷路，冷卻後只放行一個探測請求（half-open），
+    # 探測成功才恢復，失敗則重新計算冷卻時間。
+    def __init__(self, failure_threshold, cooldown, alpha):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.providers = defaultdict(lambda: {
+            "latency": None,
+            "error_rate": 0.0,
+            "failures": 0,
+            "opened_at": None,
+            "probe_started": None,
+        })
+        self.lock = threading.Lock()
+
+    def allow(self, source):
+        now = time.monotonic()
+        with self.lock:
+            p = self.providers[source]
+            if p["opened_at"] is None:
+                return True
+            if now - p["opened_at"] < self.cooldown:
+                return False
+            if p["probe_started"] is not None and now - p["probe_started"] < self.cooldown:
+                return False
+            p["probe_started"] = now
+            logging.info(f"🩺 {source} 斷路冷卻結束，放行探測請求")
+            return True
+
+    def record(self, source, ok, seconds):
+        with self.lock:
+            p = self.providers[source]
+            p["latency"] = seconds if p["latency"] is None else self.alpha * seconds + (1 - self.alpha) * p["latency"]
+            p["error_rate"] = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * p["error_rate"]
+            if ok:
+                if p["opened_at"] is not None:
+                    logging.info(f"✅ {source} 恢復正常，關閉斷路")
+                p.update(failures=0, opened_at=None, probe_started=None)
+                return
+            p["failures"] += 1
+            if p["probe_started"] is not None or p["failures"] >= self.failure_threshold:
+                p.update(opened_at=time.monotonic(), probe_started=None)
+                logging.warning(f"🚧 {source} 連續失敗 {p['failures']} 次，暫停使用 {self.cooldown:.0f} 秒")
+
+    def describe(self, source):
+        with self.lock:
+            p = dict(self.providers[source])
+        state = "🚧 暫停使用中" if p["opened_at"] is not None else "✅ 正常"
+        latency = f"{p['latency']:.1f} 秒" if p["latency"] is not None else "—"
+        return f"{state}（平均延遲 {latency}，錯誤率 {p['error_rate']:.0%}）"
+
+
+provider_health = ProviderHealth(LLM_CIRCUIT_FAILURES, LLM_CIRCUIT_COOLDOWN, LLM_HEALTH_ALPHA)
+
+
+def call_backend(user_id, user_prompt, call, prompt=None):
+    started = time.monotonic()
+    try:
+        reply = run_backend(AI_BACKENDS[call.source], user_id, user_prompt, call, prompt)
+    except Exception as e:
+        logging.error(f"{call.source} 回應失敗: {e}")
+        reply = "❌ 無法取得 AI 回覆，請稍後再試。"
+    elapsed = time.monotonic() - started
+    if call.cancelled.is_set():
+        outcome = "cancelled"
+    elif call.rejected:
+        outcome = "rejected"
+    else:
+        outcome = "ok" if call.ok else "error"
+        provider_health.record(call.source, call.ok, elapsed)
+        llm_request_seconds.observe(elapsed, call.source)
+    llm_requests_total.inc(call.source, outcome)
+    return reply
+
+
+def get_hedged_response(user_id, user_prompt, primary, secondary, deadline):
+    # 主要後端超過近期首個 token 延遲的百分位數還沒動靜，就把同一個問題丟給備援後端，
+    # 誰先完成就用誰，另一邊取消；只有勝出的那一輪會寫入記憶。
+    results = queue.Queue()
+
+    def run(call):
+        reply = call_backend(user_id, user_prompt, call)
+        call.progress.set()
+        results.put((call, reply))
+
+    calls = [LLMCall(primary, deadline, remember=False)]
+    llm_executor.submit(run, calls[0])
+
+    delay = llm_latency.percentile(primary, LLM_HEDGE_PERCENTILE)
+    delay = max(LLM_HEDGE_MIN_DELAY, delay if delay is not None else LLM_HEDGE_DEFAULT_DELAY)
+    if not calls[0].progress.wait(delay) and provider_health.allow(secondary):
+        logging.info(f"🏁 {primary} {delay:.1f} 秒內沒有回應，同時改問 {secondary}")
+        calls.append(LLMCall(secondary, deadline, remember=False))
+        llm_executor.submit(run, calls[1])
+
+    pending = len(calls)
+    while True:
+        call, reply = results.get()
+        pending -= 1
+        if call.ok or pending == 0:
+            break
+
+    for other in calls:
+        if other is not call:
+            other.cancel()
+    if call.ok:
+        memory_store.append_turn(user_id, user_prompt, reply)
+        if len(calls) > 1:
+            logging.info(f"🏁 由 {call.source} 勝出")
+    return call.ok, reply
+
+
+def ask_backend(user_id, user_prompt, source, deadline):
+    if LLM_HEDGE_SOURCE in AI_BACKENDS and LLM_HEDGE_SOURCE != source:
+        return get_hedged_response(user_id, user_prompt, source, LLM_HEDGE_SOURCE, deadline)
+    call = LLMCall(source, deadline)
+    reply = call_backend(user_id, user_prompt, call)
+    return call.ok, reply
+
+
+def get_ai_response(user_id, user_prompt, source=None, deadline=None):
     if source is None:
         source = get_user_ai_source(user_id)
-    if source == "groq":
-        return get_groq_response(user_id, user_prompt)
-    elif source == "ollama":
-        return get_ollama_response(user_id, user_prompt)
-    elif source == "gemini":
-        return get_gemini_response(user_id, user_prompt)
-    elif source == "ollama_tunnel":
-        return get_ollama_tunnel_response(user_id, user_prompt)
-    else:
+    if source not in AI_BACKENDS:
         logging.error(f"❌ 不支援的 AI 來源：{source}")
         return f"⚠️ 不支援的 AI 來源：{source}"
 
+    # 使用者選的來源優先，斷路或失敗時依 LLM_FAILOVER_ORDER 換下一個
+    candidates = list(dict.fromkeys([source] + [s for s in LLM_FAILOVER_ORDER if s in AI_BACKENDS]))
+    reply = "⚠️ 目前所有 AI 來源都暫時無法使用，請稍後再試。"
+    attempts = 0
+    for candidate in candidates:
+        if attempts >= LLM_FAILOVER_ATTEMPTS or (deadline and time.time() >= deadline):
+            break
+        if not provider_health.allow(candidate):
+            continue
+        if candidate != source:
+            logging.warning(f"🔀 {source} 無法使用，改用 {candidate}")
+        attempts += 1
+        ok, reply = ask_backend(user_id, user_prompt, candidate, deadline)
+        if ok:
+            return reply
+    return reply
+
+
+def generate_offline_reply(request, sources=None, system=None, idle_only=False):
+    # 不綁定使用者、不寫記憶的單次生成，給背景工作用；依序（預設 LLM_FAILOVER_ORDER）找第一個可用的後端。
+    # idle_only：跳過正在處理或有人排隊的後端，不讓背景工作擠掉使用者的請求
+    prompt = LLMPrompt(system or load_system_prompt(), "", "", [], request)
+    for source in sources or LLM_FAILOVER_ORDER:
+        if source not in AI_BACKENDS or not provider_health.allow(source):
+            continue
+        backend = AI_BACKENDS[source]
+        if idle_only and (backend.in_flight or backend.waiting):
+            continue
+        call = LLMCall(source, remember=False)
+        reply = call_backend(None, request, call, prompt)
+        if call.ok:
+            return reply
+    return None
+
 
 # === 重新載入所有排程 ===
 def reload_message_jobs():
     try:
-        with open("schedule.json", "r", encoding="utf-8") as f:
-            jobs = json.load(f)
+        jobs = state_store.load_scheduled_messages()
 
         for job in scheduler.get_jobs():
             if job.id.startswith("msg_"):
                 scheduler.remove_job(job.id)
 
-        for i, job in enumerate(jobs):
+        for job in jobs:
             user_id = job.get("user_id")
             time_str = job.get("time")
             message = job.get("message")
@@ -427,7 +1848,7 @@ def reload_message_jobs():
                     hour=hour,
                     minute=minute,
                     args=[user_id, message],
-                    id=f"msg_{i}"
+                    id=f"msg_{job['id']}"
                 )
                 logging.info(f"📅 新增訊息排程 {time_str} → {user_id}：{message}")
             except Exception as e:
@@ -449,6 +1870,35 @@ def start_scheduler():
         )
         logging.info("🎂 加入生日任務（每12小時）")
 
+    if not scheduler.get_job("memory_compact"):
+        scheduler.add_job(
+            memory_store.compact,
+            CronTrigger(hour=4, minute=0),
+            id="memory_compact"
+        )
+        logging.info("🗜️ 加入記憶日誌壓縮任務（每天04:00）")
+
+    if not scheduler.get_job("weather_refresh"):
+        scheduler.add_job(
+            forecast_cache.refresh,
+            trigger="interval",
+            minutes=WEATHER_REFRESH_MINUTES,
+            next_run_time=datetime.now(),
+            id="weather_refresh"
+        )
+        logging.info(f"🌤 加入天氣預報更新任務（每{WEATHER_REFRESH_MINUTES}分鐘）")
+
+    if not scheduler.get_job("emotion_pool_refill"):
+        scheduler.add_job(
+            emotion_pool.refill,
+            CronTrigger(hour=EMOTION_POOL_HOURS, minute=30),
+            id="emotion_pool_refill"
+        )
+        logging.info(f"💬 加入情緒語句補充任務（每天 {EMOTION_POOL_HOURS} 點半）")
+
+    if not pokemon_index:
+        pokemon_prefetcher.refill()
+
     reload_message_jobs()
 
     if not scheduler.running:
@@ -458,14 +1908,13 @@ def start_scheduler():
 
 def send_single_message(user_id, message):
     try:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text=message)]
-                )
+        line_bot_api = line_client.get()
+        line_bot_api.push_message(
+            PushMessageRequest(
+                to=user_id,
+                messages=[TextMessage(text=message)]
             )
+        )
         logging.info(f"✅ 傳送訊息給 {user_id}：{message}")
     except Exception as e:
         logging.error(f"❌ 傳送訊息給 {user_id} 失敗：{str(e)}")
@@ -475,25 +1924,24 @@ def check_and_send_birthday_wishes():
     today_mmdd = datetime.now().strftime("%m-%d")
     profiles = load_user_profiles()
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    line_bot_api = line_client.get()
 
-        for user_id, profile in profiles.items():
-            birthday = profile.get("birthday")
-            name = profile.get("name", "朋友")
+    for user_id, profile in profiles.items():
+        birthday = profile.get("birthday")
+        name = profile.get("name", "朋友")
 
-            try:
-                if birthday and datetime.strptime(birthday, "%Y-%m-%d").strftime("%m-%d") == today_mmdd:
-                    message = f"🎂 生日快樂，{name}！{BOT_NAME}祝你每天都快樂幸福！🧸🎉"
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text=message)]
-                        )
+        try:
+            if birthday and datetime.strptime(birthday, "%Y-%m-%d").strftime("%m-%d") == today_mmdd:
+                message = f"🎂 生日快樂，{name}！{BOT_NAME}祝你每天都快樂幸福！🧸🎉"
+                line_bot_api.push_message(
+                    PushMessageRequest(
+                        to=user_id,
+                        messages=[TextMessage(text=message)]
                     )
-                    logging.info(f"🎉 已發送生日快樂訊息給 {user_id}")
-            except Exception as e:
-                logging.error(f"❌ 發送生日訊息失敗：{str(e)}")
+                )
+                logging.info(f"🎉 已發送生日快樂訊息給 {user_id}")
+        except Exception as e:
+            logging.error(f"❌ 發送生日訊息失敗：{str(e)}")
 
 
 def load_combined_tone(file_path="descriptions.txt"):
@@ -507,8 +1955,7 @@ def load_combined_tone(file_path="descriptions.txt"):
 
     default_suffixes = ["皮熊陪你開始新的一天", "一起加油吧！", "今天也是好日子唷"]
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            lines = [line.strip() for line in f if line.strip()]
+        lines = resource_cache.get(file_path, read_lines_file)
         suffix = random.choice(lines) if lines else random.choice(default_suffixes)
     except Exception as e:
         logging.warning(f"讀取 {file_path} 失敗，使用預設語句：{e}")
@@ -519,8 +1966,7 @@ def load_combined_tone(file_path="descriptions.txt"):
 
 def load_titles(file_path="titles.json"):
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return resource_cache.get(file_path, read_json_file)
     except Exception:
         return {}
 
@@ -530,39 +1976,130 @@ def get_title_by_name(name):
     return title_map.get(name, title_map.get(name.lower(), "朋友"))
 
 
-def load_user_profiles(file_path="user_profiles.json"):
+def load_user_profiles():
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        refresh_user_profiles()
+        return state_store.load_profiles()
     except Exception as e:
-        logging.error(f"讀取 user_profiles.json 失敗：{e}")
+        logging.error(f"讀取使用者個人檔案失敗：{e}")
         return {}
 
 
 def get_emotion_line(category):
     try:
-        with open("emotions.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = resource_cache.get("emotions.json", read_json_file)
         return random.choice(data.get(category, [f"{BOT_NAME}現在腦袋空空QQ"]))
     except Exception as e:
         logging.error("讀取情緒語錄失敗: %s", str(e))
         return f"{BOT_NAME}壞掉了...請再說一次QQ"
 
 
+EMOTION_LABELS = {
+    "comfort": "安慰",
+    "cute": "撒嬌",
+    "welcome": "歡迎",
+    "encourage": "鼓勵",
+    "hit": "被打很委屈",
+}
+
+
+class EmotionLinePool:
+    # 按按鈕時直接從池子拿現成的 AI 句子，不必等 LLM；池子存在 state.db，重啟後還在。
+    # 補充只在排程的離峰時段進行，一次請模型寫一批；池子空了就退回 emotions.json。
+    def __init__(self, size, batch):
+        self.size = size
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.refilling = False
+        self.dirty = False
+        self.flush_timer = FlushTimer("emotion-pool-flush", MEMORY_FLUSH_SECONDS, self.flush)
+        try:
+            saved = json.loads(state_store.get_meta("emotion_pool", "{}"))
+        except ValueError:
+            saved = {}
+        self.pools = {category: deque(saved.get(category, []), maxlen=size) for category in EMOTION_LABELS}
+
+    def take(self, category):
+        with self.lock:
+            pool = self.pools.get(category)
+            if not pool:
+                return None
+            # 拿走的句子由寫回任務存回 state.db，重啟後才不會再出現
+            self.dirty = True
+            item = pool.popleft()
+        self.flush_timer.start()
+        return item
+
+    def _save(self):
+        with self.lock:
+            data = {category: list(pool) for category, pool in self.pools.items()}
+            self.dirty = False
+        state_store.set_meta("emotion_pool", json.dumps(data, ensure_ascii=False))
+
+    def flush(self):
+        if self.dirty:
+            self._save()
+
+    def _generate(self, category, count):
+        reply = generate_offline_reply(
+            f"請用充滿「{EMOTION_LABELS[category]}」情緒的方式對我說 {count} 句不同的話，"
+            "每句一行，不要編號也不要其他說明"
+        )
+        lines = []
+        for line in (reply or "").splitlines():
+            line = line.strip().lstrip("-•*0123456789.、） ").strip("「」\"' ")
+            if 2 <= len(line) <= 60:
+                lines.append(line)
+        return lines
+
+    def refill(self):
+        with self.lock:
+            if self.refilling:
+                return
+            self.refilling = True
+        try:
+            added = 0
+            for category in EMOTION_LABELS:
+                # 每類最多試三批，避免模型一直回不合格式時卡住
+                for _ in range(3):
+                    missing = self.size - len(self.pools[category])
+                    if missing <= 0:
+                        break
+                    lines = self._generate(category, min(self.batch, missing))
+                    if not lines:
+                        break
+                    with self.lock:
+                        self.pools[category].extend(lines)
+                    added += len(lines)
+            if added:
+                self._save()
+            logging.info(f"💬 情緒語句池補充 {added} 句")
+        except Exception as e:
+            logging.error(f"❌ 補充情緒語句池失敗：{e}")
+        finally:
+            with self.lock:
+                self.refilling = False
+
+
+emotion_pool = EmotionLinePool(EMOTION_POOL_SIZE, EMOTION_POOL_BATCH)
+atexit.register(emotion_pool.flush)
+
+
 def safe_reply(api, user_id, reply_token, messages):
     try:
         api.reply_message_with_http_info(
             ReplyMessageRequest(reply_token=reply_token, messages=messages)
         )
         logging.info(f"✅ 使用 reply_token 傳送訊息給 {user_id}")
+        line_reply_total.inc("ok")
     except ApiException as e:
         logging.warning(f"⚠️ reply_token 失效或錯誤：{e}")
+        line_reply_total.inc("invalid_token" if e.status == 400 else "api_error")
 
 
 def get_random_imgur_link(file_path="url.txt"):
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            links = [line.strip() for line in f if line.strip()]
+        links = resource_cache.get(file_path, read_lines_file)
 
         if not links:
             return None
@@ -579,39 +2116,259 @@ def get_random_imgur_link(file_path="url.txt"):
         return None
 
 
-def log_user_usage(user_id, display_name):
-    today = datetime.now().strftime('%Y-%m-%d')
-    with open('user_usage.log', 'a', encoding='utf-8') as f:
-        f.write(f"{today},{user_id},{display_name}\n")
+# === 使用次數統計 ===
+# 本日／本週／本月／全部的每人次數與連續天數都留在記憶體，增量定期寫入 usage_daily 彙總表；
+# 啟動時從彙總表還原，user_usage.log 只在第一次建立彙總時掃描。
+USAGE_PERIOD_LABELS = {
+    "day": "今日",
+    "week": "本週",
+    "month": "本月",
+    "all": "歷史",
+}
 
 
-def get_today_usage_ranking():
-    today = datetime.now().strftime('%Y-%m-%d')
-    counts = defaultdict(int)
+def is_usage_date(date_str):
+    # user_usage.log 可能有寫到一半黏在一起的壞行，只接受標準的 YYYY-MM-DD
+    try:
+        return datetime.strptime(date_str, "%Y-%m-%d").strftime("%Y-%m-%d") == date_str
+    except (TypeError, ValueError):
+        return False
+
+
+def usage_period_keys(date_str):
+    year, week, _ = datetime.strptime(date_str, "%Y-%m-%d").isocalendar()
+    return {
+        "day": date_str,
+        "week": f"{year}-W{week:02d}",
+        "month": date_str[:7],
+        "all": "",
+    }
 
-    if not os.path.exists("user_usage.log"):
-        return "今天還沒人來找皮玩QQ"
 
-    with open("user_usage.log", "r", encoding="utf-8") as f:
-        for line in f:
-            parts = line.strip().split(",")
-            if len(parts) != 3:
-                continue
-            date, _, name = parts
-            if date == today:
-                counts[name] += 1
+class UsageAggregator:
+    def __init__(self, store, snapshot_seconds):
+        self.store = store
+        self.periods = defaultdict(lambda: defaultdict(int))
+        self.names = {}
+        self.streaks = {}
+        self.deltas = defaultdict(int)
+        self.lock = threading.Lock()
+        self.flush_timer = FlushTimer("usage-snapshot", snapshot_seconds, self.snapshot)
+
+    def load(self):
+        if not self.store.get_meta("usage_rollup_built"):
+            self._import_log(USAGE_LOG_FILE)
+            self.store.set_meta("usage_rollup_built", datetime.now().isoformat())
+
+        current = usage_period_keys(datetime.now().strftime("%Y-%m-%d"))
+        skipped = 0
+        with self.lock:
+            for date, user_id, display_name, count in self.store.load_usage_rollup():
+                if not is_usage_date(date):
+                    skipped += 1
+                    continue
+                for period, key in usage_period_keys(date).items():
+                    if current[period] == key:
+                        self.periods[(period, key)][user_id] += count
+                self.names[user_id] = display_name
+                self._update_streak(user_id, date)
+        if skipped:
+            logging.warning(f"⚠️ 使用次數彙總有 {skipped} 筆日期格式錯誤，已略過")
+
+    def _import_log(self, file_path):
+        if not os.path.exists(file_path):
+            return
+        counts = defaultdict(int)
+        names = {}
+        with open(file_path, "r", encoding="utf-8", newline="") as f:
+            for parts in csv.reader(f):
+                if len(parts) != 3:
+                    continue
+                date, user_id, name = parts
+                if not is_usage_date(date):
+                    continue
+                counts[(date, user_id)] += 1
+                names[user_id] = name
+        self.store.add_usage_counts(
+            [(date, user_id, names[user_id], count) for (date, user_id), count in counts.items()]
+        )
+        logging.info(f"📊 已從 {file_path} 建立使用次數彙總（{len(counts)} 筆）")
+
+    def _update_streak(self, user_id, date):
+        # 呼叫端需持有 self.lock；date 需依時間順序傳入
+        streak = self.streaks.get(user_id)
+        if streak is None:
+            self.streaks[user_id] = {"last": date, "current": 1, "best": 1}
+            return
+        if date <= streak["last"] or not is_usage_date(date):
+            return
+        yesterday = (datetime.strptime(date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+        streak["current"] = streak["current"] + 1 if streak["last"] == yesterday else 1
+        streak["best"] = max(streak["best"], streak["current"])
+        streak["last"] = date
+
+    def record(self, date, user_id, display_name):
+        with self.lock:
+            for period, key in usage_period_keys(date).items():
+                self.periods[(period, key)][user_id] += 1
+            self.names[user_id] = display_name
+            self._update_streak(user_id, date)
+            self.deltas[(date, user_id)] += 1
+        self.flush_timer.start()
+
+    def top(self, period, limit=5):
+        key = usage_period_keys(datetime.now().strftime("%Y-%m-%d"))[period]
+        with self.lock:
+            counts = dict(self.periods.get((period, key), {}))
+            names = dict(self.names)
+        ranked = sorted(counts.items(), key=lambda x: x[1], reverse=True)[:limit]
+        return [(names.get(user_id, user_id), count) for user_id, count in ranked]
+
+    def get_streak(self, user_id):
+        # 回傳 (目前連續天數, 最長連續天數)；昨天以前就中斷的話目前天數為 0
+        today = datetime.now()
+        alive = {today.strftime("%Y-%m-%d"), (today - timedelta(days=1)).strftime("%Y-%m-%d")}
+        with self.lock:
+            streak = self.streaks.get(user_id)
+            if not streak:
+                return 0, 0
+            current = streak["current"] if streak["last"] in alive else 0
+            return current, streak["best"]
+
+    def snapshot(self):
+        current = set(usage_period_keys(datetime.now().strftime("%Y-%m-%d")).items())
+        with self.lock:
+            rows = [
+                (date, user_id, self.names.get(user_id, user_id), delta)
+                for (date, user_id), delta in self.deltas.items()
+            ]
+            self.deltas.clear()
+            for period_key in [k for k in self.periods if k not in current]:
+                del self.periods[period_key]
+        if rows:
+            try:
+                self.store.add_usage_counts(rows)
+            except Exception as e:
+                logging.error(f"❌ 寫入使用次數彙總失敗：{e}")
+                with self.lock:
+                    for date, user_id, _, delta in rows:
+                        self.deltas[(date, user_id)] += delta
+
+
+usage_aggregator = UsageAggregator(state_store, USAGE_SNAPSHOT_SECONDS)
+usage_aggregator.load()
+atexit.register(usage_aggregator.snapshot)
+
+
+class UsageRecorder:
+    # 熱路徑只更新記憶體中的排行榜計數並 queue.put；
+    # 背景執行緒最多等 flush_seconds 或湊滿一批就以 CSV 寫入 user_usage.log
+    def __init__(self, file_path, aggregator, flush_seconds, batch_size):
+        self.file_path = file_path
+        self.aggregator = aggregator
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="usage-recorder", daemon=True)
+                self.thread.start()
+
+    def record(self, user_id, display_name):
+        if self.thread is None:
+            self.start()
+        date = datetime.now().strftime('%Y-%m-%d')
+        self.aggregator.record(date, user_id, display_name)
+        self.queue.put((date, user_id, display_name))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self.queue.get()
+            if item is None:
+                stopping = True
+            else:
+                batch.append(item)
+
+            deadline = time.monotonic() + self.flush_seconds
+            while not stopping and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        try:
+            with open(self.file_path, "a", encoding="utf-8", newline="") as f:
+                csv.writer(f, lineterminator="\n").writerows(batch)
+        except Exception as e:
+            logging.error(f"❌ 寫入 {self.file_path} 失敗：{e}")
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+        leftovers = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                leftovers.append(item)
+        if leftovers:
+            self._write(leftovers)
+
+
+usage_recorder = UsageRecorder(USAGE_LOG_FILE, usage_aggregator, USAGE_FLUSH_SECONDS, USAGE_BATCH_SIZE)
+atexit.register(usage_recorder.stop)
+
 
-    if not counts:
-        return "今天還沒人來找皮玩QQ"
+def log_user_usage(user_id, display_name):
+    usage_recorder.record(user_id, display_name)
+
+
+def get_usage_ranking(period="day"):
+    ranked = usage_aggregator.top(period)
+    label = USAGE_PERIOD_LABELS[period]
 
-    sorted_counts = sorted(counts.items(), key=lambda x: x[1], reverse=True)
-    return "🐾 今日 皮 陪伴排行榜 🧸\n" + "\n".join(
-        [f"{i+1}. {name}：{count} 次" for i, (name, count) in enumerate(sorted_counts[:5])]
+    if not ranked:
+        return "今天還沒人來找皮玩QQ" if period == "day" else f"{label}還沒人來找皮玩QQ"
+
+    return f"🐾 {label} 皮 陪伴排行榜 🧸\n" + "\n".join(
+        [f"{i+1}. {name}：{count} 次" for i, (name, count) in enumerate(ranked)]
     )
 
 
+def get_today_usage_ranking():
+    return get_usage_ranking("day")
+
+
+def get_streak_text(user_id, title):
+    current, best = usage_aggregator.get_streak(user_id)
+    if current == 0:
+        return f"🐾 {title}好久沒來找皮玩了～今天開始重新累積吧！（最長紀錄 {best} 天）"
+    return f"🔥 {title}已經連續 {current} 天來找皮玩囉！\n🏆 最長紀錄：{best} 天"
+
+
 def get_greeting_for_user(user_id):
-    profile = load_user_profiles().get(user_id, {})
+    profile = get_user_profile(user_id)
     name = profile.get("name", "朋友")
     relation = profile.get("與皮熊關係", "")
     return f"{name}（{relation}），新的一天開始囉～皮陪你！" if relation else f"{name}，新的一天開始囉～皮陪你！"
@@ -622,113 +2379,517 @@ def get_today_info():
     return today.strftime("%Y/%m/%d") + f"（星期{'一二三四五六日'[today.weekday()]}）"
 
 
-def load_user_city_map(file_path="user_cities.json"):
+def save_user_city(name, city):
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-
-def save_user_city(name, city, file_path="user_cities.json"):
-    try:
-        data = load_user_city_map()
-        data[name] = city
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        state_store.save_cities({name: city})
     except Exception as e:
         logging.error("儲存使用者城市失敗: %s", str(e))
 
 
 def reverse_geocode_to_city(lat, lon):
     try:
-        res = requests.get(
-            f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}&zoom=10&addressdetails=1",
+        res = http_get(
+            "https://nominatim.openstreetmap.org/reverse",
+            params={"format": "json", "lat": lat, "lon": lon, "zoom": 10, "addressdetails": 1},
             headers={"User-Agent": "LineBotDemo/1.0"},
             timeout=15
         )
         data = res.json()
         addr = data.get("address", {})
-        return addr.get("city") or addr.get("town") or addr.get("county") or "未知地區"
+        city = addr.get("city") or addr.get("town") or addr.get("county")
+        # CWA 的 locationName 一律用「臺」
+        return city.replace("台", "臺") if city else "未知地區"
     except Exception as e:
         logging.error("地理編碼失敗: %s", str(e))
         return "無法取得縣市資訊"
 
 
-def get_weather_info(name, default_city="臺北市"):
-    city = load_user_city_map().get(name, default_city)
-    url = "https://opendata.cwa.gov.tw/api/v1/rest/datastore/F-C0032-001"
-    params = {
-        "Authorization": CWA_API_KEY,
-        "locationName": city
-    }
+# === 天氣預報快取 ===
+# 排程一次抓回 F-C0032-001 全部縣市，整理成 {縣市: {要素: [各時段值]}} 留在記憶體；
+# 資料過期時先回舊資料並在背景更新，CWA 掛掉時繼續用最後一次成功的結果。
+CWA_FORECAST_URL = "https://opendata.cwa.gov.tw/api/v1/rest/datastore/F-C0032-001"
+
 
-    for attempt in range(3):
+class ForecastCache:
+    def __init__(self, refresh_seconds, retry_seconds):
+        self.refresh_seconds = refresh_seconds
+        self.retry_seconds = retry_seconds
+        self.forecasts = {}
+        self.fetched_at = 0
+        self.failed_at = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+        # 同一時間只有一個執行緒向 CWA 抓資料
+        self.fetch_lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            with self.fetch_lock:
+                return self._fetch()
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def _fetch(self):
+        # 呼叫端需持有 self.fetch_lock
         try:
-            res = requests.get(url, params=params, timeout=5)
+            res = http_get(CWA_FORECAST_URL, params={"Authorization": CWA_API_KEY}, timeout=10)
             res.raise_for_status()
-            data = res.json()
-
-            location = data["records"]["location"][0]["weatherElement"]
-
-            def extract(element_name, day_index):
-                for e in location:
-                    if e["elementName"] == element_name:
-                        return e["time"][day_index]["parameter"]["parameterName"]
-                return "？"
-
-            wx_today = extract("Wx", 0)
-            minT_today = extract("MinT", 0)
-            maxT_today = extract("MaxT", 0)
-            pop_today = extract("PoP", 0)
-
-            wx_tomorrow = extract("Wx", 1)
-            minT_tomorrow = extract("MinT", 1)
-            maxT_tomorrow = extract("MaxT", 1)
-            pop_tomorrow = extract("PoP", 1)
-
-            return (
-                f"🌤 今天天氣：{wx_today}，🌧️ 降雨機率：{pop_today}%\n"
-                f"🌡️ 氣溫：{minT_today}~{maxT_today}°C\n\n"
-                f"🌦 明天天氣：{wx_tomorrow}，🌧️ 降雨機率：{pop_tomorrow}%\n"
-                f"🌡️ 氣溫：{minT_tomorrow}~{maxT_tomorrow}°C"
-            )
+            forecasts = {}
+            for location in res.json()["records"]["location"]:
+                forecasts[location["locationName"]] = {
+                    e["elementName"]: [t["parameter"]["parameterName"] for t in e["time"]]
+                    for e in location["weatherElement"]
+                }
+            with self.lock:
+                self.forecasts = forecasts
+                self.fetched_at = time.time()
+            logging.info(f"🌤 已更新 {len(forecasts)} 個縣市的天氣預報")
+            return True
+        except Exception as e:
+            self.failed_at = time.time()
+            logging.warning(f"[天氣預報更新失敗] {str(e)}")
+            return False
+
+    def _fetch_initial(self):
+        # 還沒有任何資料時，只讓第一個請求去抓，其他請求等它的結果；
+        # CWA 剛失敗過 retry_seconds 內就直接放棄，不讓每個請求都去重試
+        with self.fetch_lock:
+            if self.forecasts or time.time() - self.failed_at < self.retry_seconds:
+                return
+            self._fetch()
+
+    def get(self, city):
+        if not self.forecasts:
+            cache_requests_total.inc("forecast", "miss")
+            self._fetch_initial()
+        elif time.time() - self.fetched_at > self.refresh_seconds:
+            cache_requests_total.inc("forecast", "stale")
+            with self.lock:
+                start = not self.refreshing
+                self.refreshing = True
+            if start:
+                background_executor.submit(self.refresh)
+        else:
+            cache_requests_total.inc("forecast", "hit")
+        return self.forecasts.get(city)
+
+
+forecast_cache = ForecastCache(WEATHER_REFRESH_MINUTES * 60, WEATHER_RETRY_SECONDS)
+
+
+def get_weather_info(name, default_city="臺北市"):
+    city = state_store.get_city(name) or default_city
+    forecast = forecast_cache.get(city)
+    if not forecast:
+        logging.warning(f"[天氣查詢失敗] 沒有 {city} 的預報資料")
+        return "🌥 無法取得天氣資料"
+
+    def extract(element_name, day_index):
+        values = forecast.get(element_name, [])
+        return values[day_index] if day_index < len(values) else "？"
+
+    wx_today = extract("Wx", 0)
+    minT_today = extract("MinT", 0)
+    maxT_today = extract("MaxT", 0)
+    pop_today = extract("PoP", 0)
+
+    wx_tomorrow = extract("Wx", 1)
+    minT_tomorrow = extract("MinT", 1)
+    maxT_tomorrow = extract("MaxT", 1)
+    pop_tomorrow = extract("PoP", 1)
+
+    return (
+        f"🌤 今天天氣：{wx_today}，🌧️ 降雨機率：{pop_today}%\n"
+        f"🌡️ 氣溫：{minT_today}~{maxT_today}°C\n\n"
+        f"🌦 明天天氣：{wx_tomorrow}，🌧️ 降雨機率：{pop_tomorrow}%\n"
+        f"🌡️ 氣溫：{minT_tomorrow}~{maxT_tomorrow}°C"
+    )
+
+
+# === 寶可夢 ===
+# 優先使用 build_pokemon_index.py 產生的本地索引；沒有索引時，從背景預先抓好的池子裡拿一隻。
+POKEMON_MAX_ID = 1010
+
+
+def fetch_pokemon(pokemon_id):
+    data = http_get(f"https://pokeapi.co/api/v2/pokemon/{pokemon_id}", timeout=15).json()
+    species_data = http_get(data['species']['url'], timeout=15).json()
+    return {
+        "id": data['id'],
+        "name_en": data['name'].capitalize(),
+        "name_zh": next((n['name'] for n in species_data.get("names", []) if n['language']['name'] == 'zh-Hant'), ""),
+        "types": [t['type']['name'] for t in data['types']],
+        "height": data['height'] / 10,
+        "weight": data['weight'] / 10,
+        "image": data['sprites']['other']['official-artwork']['front_default'],
+    }
+
+
+def format_pokemon(entry):
+    name_en, name_zh = entry["name_en"], entry["name_zh"]
+    display_name = f"{name_en}（{name_zh}）" if name_zh else name_en
+    types = "、".join(entry["types"])
+    return (
+        f"{display_name}\n屬性：{types}\n身高：{entry['height']} 公尺\n體重：{entry['weight']} 公斤",
+        entry["image"]
+    )
+
 
+def load_pokemon_index(file_path=POKEMON_INDEX_FILE):
+    if not os.path.exists(file_path):
+        logging.info(f"ℹ️ 找不到 {file_path}，寶可夢改用線上預抓池")
+        return []
+    try:
+        index = read_json_file(file_path)
+        logging.info(f"🎲 已載入 {len(index)} 隻寶可夢")
+        return index
+    except Exception as e:
+        logging.error(f"讀取 {file_path} 失敗：{e}")
+        return []
+
+
+class PokemonPrefetcher:
+    def __init__(self, size):
+        self.size = size
+        self.pool = deque()
+        self.filling = False
+        self.lock = threading.Lock()
+
+    def _fill(self):
+        try:
+            while len(self.pool) < self.size:
+                self.pool.append(fetch_pokemon(random.randint(1, POKEMON_MAX_ID)))
         except Exception as e:
-            logging.warning(f"[天氣查詢失敗] 第 {attempt + 1} 次：{str(e)}")
+            logging.warning(f"⚠️ 預抓寶可夢失敗：{e}")
+        finally:
+            with self.lock:
+                self.filling = False
+
+    def refill(self):
+        with self.lock:
+            if self.filling or len(self.pool) >= self.size:
+                return
+            self.filling = True
+        background_executor.submit(self._fill)
+
+    def take(self):
+        try:
+            entry = self.pool.popleft()
+        except IndexError:
+            entry = None
+        self.refill()
+        return entry
+
 
-    return "🌥 無法取得天氣資料"
+pokemon_index = load_pokemon_index()
+pokemon_prefetcher = PokemonPrefetcher(POKEMON_POOL_SIZE)
 
 
 def get_random_pokemon():
     try:
-        random_id = random.randint(1, 1010)
-        data = requests.get(f"https://pokeapi.co/api/v2/pokemon/{random_id}", timeout=15).json()
-        name_en = data['name'].capitalize()
-        height, weight = data['height'] / 10, data['weight'] / 10
-        types = "、".join(t['type']['name'] for t in data['types'])
-        species_url = data['species']['url']
-        species_data = requests.get(species_url, timeout=15).json()
-        name_zh = next((n['name'] for n in species_data.get("names", []) if n['language']['name'] == 'zh-Hant'), "")
-        display_name = f"{name_en}（{name_zh}）" if name_zh else name_en
-        image = data['sprites']['other']['official-artwork']['front_default']
-        return f"{display_name}\n屬性：{types}\n身高：{height} 公尺\n體重：{weight} 公斤", image
+        if pokemon_index:
+            return format_pokemon(random.choice(pokemon_index))
+        entry = pokemon_prefetcher.take() or fetch_pokemon(random.randint(1, POKEMON_MAX_ID))
+        return format_pokemon(entry)
     except Exception as e:
         logging.error("取得寶可夢失敗: %s", str(e))
         return "未知寶可夢", None
 
 
+# === AI 使用頻率限制 ===
+class RateLimiter:
+    # 每位使用者一個 token bucket，外加一個全體共用的 bucket；兩邊都有額度才放行並同時扣除。
+    # bucket 存在記憶體（LRU，超過 capacity 的閒置使用者直接丟掉，等同額度全滿）；
+    # 開啟 persist 時定期寫進 state.db 的 meta，重啟後接續計算。
+    def __init__(self, user_burst, user_per_minute, global_burst, global_per_minute, persist, capacity=10000):
+        self.user_burst = user_burst
+        self.user_rate = user_per_minute / 60
+        self.global_burst = global_burst
+        self.global_rate = global_per_minute / 60
+        self.persist = persist
+        self.capacity = capacity
+        self.buckets = OrderedDict()
+        self.global_bucket = [global_burst, time.time()]
+        self.limited = 0
+        self.lock = threading.Lock()
+        self.flush_timer = FlushTimer("rate-limit-flush", MEMORY_FLUSH_SECONDS, self.flush)
+        if persist:
+            try:
+                saved = json.loads(state_store.get_meta("rate_buckets", "{}"))
+                self.buckets.update((k, list(v)) for k, v in saved.get("users", {}).items())
+                self.global_bucket = list(saved.get("global", self.global_bucket))
+            except ValueError:
+                logging.warning("⚠️ 頻率限制狀態損毀，重新計算")
+
+    @staticmethod
+    def _refill(bucket, burst, rate, now):
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+    def acquire(self, user_id):
+        # 回傳 (是否放行, 還要等幾秒, 被哪個 bucket 擋下："user" / "global")
+        if self.persist:
+            self.flush_timer.start()
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.pop(user_id, None) or [self.user_burst, now]
+            self.buckets[user_id] = bucket
+            while len(self.buckets) > self.capacity:
+                self.buckets.popitem(last=False)
+            self._refill(bucket, self.user_burst, self.user_rate, now)
+            self._refill(self.global_bucket, self.global_burst, self.global_rate, now)
+
+            if bucket[0] < 1:
+                self.limited += 1
+                return False, (1 - bucket[0]) / self.user_rate if self.user_rate else None, "user"
+            if self.global_bucket[0] < 1:
+                self.limited += 1
+                return False, (1 - self.global_bucket[0]) / self.global_rate if self.global_rate else None, "global"
+            bucket[0] -= 1
+            self.global_bucket[0] -= 1
+            return True, 0, None
+
+    def flush(self):
+        if not self.persist:
+            return
+        now = time.time()
+        with self.lock:
+            # 已補滿的 bucket 跟新使用者一樣，不必存
+            users = {
+                k: v for k, v in self.buckets.items()
+                if v[0] + (now - v[1]) * self.user_rate < self.user_burst
+            }
+            data = {"users": users, "global": self.global_bucket}
+        state_store.set_meta("rate_buckets", json.dumps(data))
+
+
+ai_rate_limiter = RateLimiter(AI_USER_BURST, AI_USER_PER_MINUTE, AI_GLOBAL_BURST, AI_GLOBAL_PER_MINUTE, AI_RATE_PERSIST)
+atexit.register(ai_rate_limiter.flush)
+
+
+def get_rate_limited_text(scope, retry_after):
+    wait = f"{math.ceil(retry_after)} 秒後" if retry_after else "晚一點"
+    if scope == "global":
+        head = f"現在好多人找{BOT_NAME}聊天，{wait}再來找我好嗎？"
+    else:
+        head = f"講太快了啦～{BOT_NAME}跟不上，{wait}再聊好嗎？"
+    return f"{BOT_NAME}:{head}\n{get_emotion_line('cute')}"
+
+
+# === 背景事件處理 ===
+# /callback 只驗簽、排入佇列就回 200，真正的處理交給 worker。
+# 同一個 user_id 永遠分到同一條佇列，確保訊息依序處理。
+event_routes = {}
+
+
+def route_event(event_type, message=None):
+    def decorator(func):
+        event_routes[(event_type, message)] = func
+        return func
+    return decorator
+
+
+def get_event_key(event):
+    source = event.source
+    for attr in ("user_id", "group_id", "room_id"):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return ""
+
+
+def dispatch_event(event, received_at):
+    message = getattr(event, "message", None)
+    func = event_routes.get((type(event), type(message))) or event_routes.get((type(event), None))
+    if func is None:
+        logging.info(f"略過未處理的事件：{type(event).__name__}")
+        return
+
+    wait = time.time() - received_at
+    event_queue_wait_seconds.observe(wait)
+    if wait > 1:
+        logging.warning(f"⏳ 事件在佇列等待 {wait:.1f} 秒：{get_event_key(event)}")
+    with event_handle_seconds.time(func.__name__):
+        func(event, received_at)
+    # 回覆送出後才濃縮放不進提示的舊對話
+    memory_summarizer.kick(getattr(getattr(event, "source", None), "user_id", None))
+
+
+class EventDeduper:
+    # webhookEventId → 第一次收到的時間，只保留 window 秒內、最多 capacity 筆；
+    # 開啟 persist 時新 id 由背景執行緒批次寫進 state.db，啟動時載回，記憶體擠掉的舊 id 也會回頭查資料庫。
+    def __init__(self, window, capacity, persist):
+        self.window = window
+        self.capacity = capacity
+        self.persist = persist
+        self.seen = OrderedDict()
+        self.unsaved = {}
+        self.evicted = False
+        self.lock = threading.Lock()
+        self.flush_timer = FlushTimer("event-dedup-flush", MEMORY_FLUSH_SECONDS, self.flush)
+        if persist:
+            for event_id, seen_at in state_store.load_webhook_events(time.time() - window):
+                self.seen[event_id] = seen_at
+            self._expire(time.time())
+
+    def _expire(self, now):
+        # 呼叫端需持有 self.lock（初始化時除外）
+        while self.seen:
+            seen_at = next(iter(self.seen.values()))
+            if now - seen_at < self.window and len(self.seen) <= self.capacity:
+                break
+            self.seen.popitem(last=False)
+            if now - seen_at < self.window:
+                self.evicted = True
+
+    def add(self, event_id):
+        # 第一次看到回傳 True；window 內重複出現回傳 False
+        now = time.time()
+        with self.lock:
+            seen_at = self.seen.get(event_id)
+            duplicate = seen_at is not None and now - seen_at < self.window
+            if not duplicate and seen_at is None and self.persist and self.evicted:
+                duplicate = event_id in self.unsaved or state_store.has_webhook_event(event_id, now - self.window)
+            if duplicate:
+                return False
+            self.seen[event_id] = now
+            self.seen.move_to_end(event_id)
+            self._expire(now)
+            if self.persist:
+                self.unsaved[event_id] = now
+        if self.persist:
+            self.flush_timer.start()
+        return True
+
+    def flush(self):
+        if not self.persist:
+            return
+        with self.lock:
+            rows, self.unsaved = self.unsaved, {}
+        if rows:
+            state_store.add_webhook_events(list(rows.items()), time.time() - self.window)
+
+
+event_deduper = EventDeduper(EVENT_DEDUP_SECONDS, EVENT_DEDUP_SIZE, EVENT_DEDUP_PERSIST)
+atexit.register(event_deduper.flush)
+
+
+class EventDispatcher:
+    # 每個 user_id 一個信箱：同一人的事件依序處理，不會兩則訊息同時讀寫記憶；
+    # worker 從就緒佇列挑有事件的信箱，某人卡在 LLM 時不會擋到其他人。
+    # 全部信箱的待處理總數有上限，滿了之後的訊息直接回罐頭句子。
+    def __init__(self, worker_count, limit):
+        self.worker_count = max(1, worker_count)
+        self.limit = limit
+        self.mailboxes = {}
+        self.ready = queue.Queue()
+        self.queued = 0
+        self.shed_backlog = 0
+        self.threads = []
+        self.lock = threading.Lock()
+        self.shed_executor = ThreadPoolExecutor(max_workers=SHED_WORKERS, thread_name_prefix="shed")
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.worker_count):
+                t = threading.Thread(target=self._run, name=f"event-worker-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+        logging.info(f"🧵 啟動 {self.worker_count} 個事件 worker（佇列上限 {self.limit}）")
+
+    def submit(self, event):
+        if not self.threads:
+            self.start()
+        key = get_event_key(event)
+        with self.lock:
+            # 追蹤/封鎖等事件量小又會改狀態，一律收下；只有訊息會被擋
+            shed = self.queued >= self.limit and isinstance(event, MessageEvent)
+            reply_shed = shed and self.shed_backlog < SHED_BACKLOG
+            if reply_shed:
+                self.shed_backlog += 1
+            elif not shed:
+                self.queued += 1
+                mailbox = self.mailboxes.get(key)
+                if mailbox is None:
+                    self.mailboxes[key] = deque([(event, time.time())])
+                    self.ready.put(key)
+                else:
+                    mailbox.append((event, time.time()))
+        if reply_shed:
+            logging.warning(f"🚦 事件佇列已滿（{self.limit}），改回罐頭訊息：{key}")
+            self.shed_executor.submit(self._shed, event)
+        elif shed:
+            logging.warning(f"🚦 事件佇列與罐頭回覆都已滿，略過：{key}")
+        return not shed
+
+    def _shed(self, event):
+        try:
+            shed_event(event)
+        finally:
+            with self.lock:
+                self.shed_backlog -= 1
+
+    def pending(self):
+        with self.lock:
+            return self.queued
+
+    def _run(self):
+        while True:
+            key = self.ready.get()
+            with self.lock:
+                event, received_at = self.mailboxes[key].popleft()
+            try:
+                dispatch_event(event, received_at)
+            except Exception as e:
+                logging.exception("背景處理事件失敗: %s", str(e))
+            finally:
+                # 處理期間信箱一直留著，新事件只會排進去，不會被別的 worker 同時拿走
+                with self.lock:
+                    self.queued -= 1
+                    if self.mailboxes[key]:
+                        self.ready.put(key)
+                    else:
+                        del self.mailboxes[key]
+
+
+def shed_event(event):
+    reply_token = getattr(event, "reply_token", None)
+    if not reply_token:
+        return
+    text = f"{BOT_NAME}:現在好多人找{BOT_NAME}，等我一下下再聊喔～\n{get_emotion_line('cute')}"
+    safe_reply(line_client.get(), get_event_key(event), reply_token, [TextMessage(text=text)])
+
+
+event_dispatcher = EventDispatcher(EVENT_WORKERS, EVENT_QUEUE_LIMIT)
+
+
 # === LINE Bot Routing ===
 
 @app.route("/callback", methods=["POST"])
 def callback():
-    signature = request.headers["X-Line-Signature"]
-    body = request.get_data(as_text=True)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        logging.error("簽名驗證失敗")
-        abort(400)
+    with webhook_seconds.time():
+        signature = request.headers["X-Line-Signature"]
+        body = request.get_data(as_text=True)
+        try:
+            events = parser.parse(body, signature)
+        except InvalidSignatureError:
+            logging.error("簽名驗證失敗")
+            webhook_events_total.inc("unknown", "invalid_signature")
+            abort(400)
+
+        for event in events:
+            event_type = type(event).__name__
+            event_id = getattr(event, "webhook_event_id", None)
+            if event_id and not event_deduper.add(event_id):
+                redelivery = getattr(getattr(event, "delivery_context", None), "is_redelivery", False)
+                logging.info(f"🔁 略過重複事件 {event_id}（重送：{redelivery}）")
+                webhook_events_total.inc(event_type, "duplicate")
+                continue
+            accepted = event_dispatcher.submit(event)
+            webhook_events_total.inc(event_type, "accepted" if accepted else "shed")
     return "OK"
 
 
@@ -748,18 +2909,11 @@ def handle_emotion_message(user_input, user_id, title, name):
         category = "hit"
 
     if category:
-        msg_func = random.choices(
-            [
-                lambda: get_ai_response(
-                    user_id,
-                    f"請用充滿「{category}」情緒的方式對我說一句話",
-                ),
-                lambda: get_emotion_line(category)
-            ],
-            weights=[0.1, 0.9]
-        )[0]
-
-        msg = msg_func()
+        # 一成機率用預先生成的 AI 句子，池子空了就退回 emotions.json
+        msg = None
+        if random.random() < 0.1:
+            msg = emotion_pool.take(category)
+        msg = msg or get_emotion_line(category)
 
         messages = []
         img_url = get_random_imgur_link()
@@ -780,8 +2934,8 @@ def handle_emotion_message(user_input, user_id, title, name):
     return None
 
 
-def handle_general_chat(user_id, user_input, title, name):
-    ai_msg = get_ai_response(user_id, user_input)
+def handle_general_chat(user_id, user_input, title, name, deadline=None):
+    ai_msg = get_ai_response(user_id, user_input, deadline=deadline)
     tone = load_combined_tone()
 
     greeting = get_greeting_for_user(user_id)
@@ -790,130 +2944,144 @@ def handle_general_chat(user_id, user_input, title, name):
     return [TextMessage(text=full_msg, quick_reply=QuickReply(items=get_quick_reply_items()))]
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event):
+@route_event(MessageEvent, message=TextMessageContent)
+def handle_message(event, received_at=None):
     try:
+        deadline = get_reply_deadline(received_at)
         messages = []
         user_input = event.message.text
         user_id = event.source.user_id
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            profile = line_bot_api.get_profile(user_id)
-            name = profile.display_name
-            title = get_title_by_name(name)
-            log_user_usage(user_id, name)
-
-            if user_input.startswith("切換AI ") or user_input.startswith("切換ai "):
-                source_key = user_input.split(" ", 1)[1].strip().lower()
-                source_alias = {
-                    "groq": "groq",
-                    "gemini": "gemini",
-                    "ollama": "ollama",
-                    "內網": "ollama",
-                    "tunnel": "ollama_tunnel",
-                    "外網": "ollama_tunnel",
-                    "ollama_tunnel": "ollama_tunnel",
-                }
-                source = source_alias.get(source_key)
-                if source:
-                    save_user_ai_source(user_id, source)
-                    label = AI_SOURCE_LABELS.get(source, source)
-                    messages = [reply_with_quick(f"✅ 已切換為 {label}！\n之後的對話都會用這個模型回覆你唷～")]
-                else:
-                    options = "\n".join([f"• {k}（{v}）" for k, v in AI_SOURCE_LABELS.items()])
-                    messages = [reply_with_quick(f"⚠️ 不支援的選項，請用以下格式：\n切換AI <來源>\n\n可選：\n{options}")]
+        line_bot_api = line_client.get()
+        name = profile_cache.get_display_name(user_id)
+        title = get_title_by_name(name)
+        log_user_usage(user_id, name)
+
+        if user_input.startswith("切換AI ") or user_input.startswith("切換ai "):
+            source_key = user_input.split(" ", 1)[1].strip().lower()
+            source_alias = {
+                "groq": "groq",
+                "gemini": "gemini",
+                "ollama": "ollama",
+                "內網": "ollama",
+                "tunnel": "ollama_tunnel",
+                "外網": "ollama_tunnel",
+                "ollama_tunnel": "ollama_tunnel",
+                "stub": "stub",
+            }
+            source = source_alias.get(source_key)
+            if source in AI_BACKENDS:
+                save_user_ai_source(user_id, source)
+                label = AI_SOURCE_LABELS.get(source, source)
+                messages = [reply_with_quick(f"✅ 已切換為 {label}！\n之後的對話都會用這個模型回覆你唷～")]
+            else:
+                options = "\n".join([f"• {k}（{v}）" for k, v in AI_SOURCE_LABELS.items()])
+                messages = [reply_with_quick(f"⚠️ 不支援的選項，請用以下格式：\n切換AI <來源>\n\n可選：\n{options}")]
 
-            elif user_input in ["目前AI", "AI狀態", "用哪個AI"]:
-                current = get_user_ai_source(user_id)
-                label = AI_SOURCE_LABELS.get(current, current)
-                messages = [reply_with_quick(f"🤖 目前使用：{label}\n\n輸入「切換AI groq/gemini/ollama/外網」可切換")]
+        elif user_input in ["目前AI", "AI狀態", "用哪個AI"]:
+            current = get_user_ai_source(user_id)
+            label = AI_SOURCE_LABELS.get(current, current)
+            health = provider_health.describe(current)
+            backend = AI_BACKENDS.get(current)
+            if backend:
+                health += f"\n🚦 執行中 {backend.in_flight}/{backend.concurrency}，排隊 {backend.waiting}"
+            messages = [reply_with_quick(f"🤖 目前使用：{label}\n{health}\n\n輸入「切換AI groq/gemini/ollama/外網」可切換")]
 
-            elif user_input in ["排行榜", "使用排行", "今天誰最黏皮熊？"]:
-                reply = get_today_usage_ranking()
-                messages = [reply_with_quick(reply)]
+        elif user_input in ["排行榜", "使用排行", "今天誰最黏皮熊？"]:
+            reply = get_today_usage_ranking()
+            messages = [reply_with_quick(reply)]
 
-            elif user_input == "查詢花費":
-                try:
-                    with open("usage_summary.json", "r", encoding="utf-8") as f:
-                        usage = json.load(f)
-                    today = datetime.now().strftime("%Y-%m-%d")
-                    today_data = usage.get(today, {"total_tokens": 0, "total_cost": 0.0})
-                    total_tokens = today_data["total_tokens"]
-                    total_cost = today_data["total_cost"]
-                    messages.append(
-                        TextMessage(
-                            text=f"📊 今日 Groq 使用：\nTokens：{total_tokens}\n金額：${total_cost:.6f} USD"
-                        )
+        elif user_input in ["本週排行榜", "本週排行"]:
+            messages = [reply_with_quick(get_usage_ranking("week"))]
+
+        elif user_input in ["本月排行榜", "本月排行"]:
+            messages = [reply_with_quick(get_usage_ranking("month"))]
+
+        elif user_input in ["總排行榜", "歷史排行榜"]:
+            messages = [reply_with_quick(get_usage_ranking("all"))]
+
+        elif user_input in ["連續紀錄", "我的連續紀錄"]:
+            messages = [reply_with_quick(get_streak_text(user_id, title))]
+
+        elif user_input == "查詢花費":
+            try:
+                today = datetime.now().strftime("%Y-%m-%d")
+                total_tokens, total_cost = state_store.get_groq_usage(today)
+                messages.append(
+                    TextMessage(
+                        text=f"📊 今日 Groq 使用：\nTokens：{total_tokens}\n金額：${total_cost:.6f} USD"
                     )
-                except Exception as e:
-                    messages.append(TextMessage(text=f"⚠️ 無法讀取花費資料：{str(e)}"))
+                )
+            except Exception as e:
+                messages.append(TextMessage(text=f"⚠️ 無法讀取花費資料：{str(e)}"))
 
-            elif user_input == "查詢本月花費":
-                try:
-                    with open("usage_summary.json", "r", encoding="utf-8") as f:
-                        usage = json.load(f)
-                    this_month = datetime.now().strftime("%Y-%m")
-                    total_tokens = 0
-                    total_cost = 0.0
-                    for date_str, data in usage.items():
-                        if date_str.startswith(this_month):
-                            total_tokens += data.get("total_tokens", 0)
-                            total_cost += data.get("total_cost", 0.0)
-
-                    messages.append(
-                        TextMessage(
-                            text=f"📅 本月 Groq 使用統計：\nTokens：{total_tokens:,}\n金額：${total_cost:.6f} USD"
-                        )
+        elif user_input == "查詢本月花費":
+            try:
+                this_month = datetime.now().strftime("%Y-%m")
+                total_tokens, total_cost = state_store.get_groq_usage(f"{this_month}-01", f"{this_month}-31")
+
+                messages.append(
+                    TextMessage(
+                        text=f"📅 本月 Groq 使用統計：\nTokens：{total_tokens:,}\n金額：${total_cost:.6f} USD"
                     )
-                except Exception as e:
-                    messages.append(TextMessage(text=f"⚠️ 無法讀取本月花費資料：{str(e)}"))
+                )
+            except Exception as e:
+                messages.append(TextMessage(text=f"⚠️ 無法讀取本月花費資料：{str(e)}"))
 
-            elif user_input == "天氣資訊":
-                date_info = get_today_info()
-                weather = get_weather_info(name)
-                messages = [reply_with_quick(f"📅 {date_info}\n🌤 {weather}\n")]
+        elif user_input == "天氣資訊":
+            date_info = get_today_info()
+            weather = get_weather_info(name)
+            messages = [reply_with_quick(f"📅 {date_info}\n🌤 {weather}\n")]
 
-            elif user_input == "給我一隻寶可夢":
-                name_text, img_url = get_random_pokemon()
-                messages = []
+        elif user_input == "給我一隻寶可夢":
+            name_text, img_url = get_random_pokemon()
+            messages = []
 
-                if img_url:
-                    messages.append(ImageMessage(original_content_url=img_url, preview_image_url=img_url))
+            if img_url:
+                messages.append(ImageMessage(original_content_url=img_url, preview_image_url=img_url))
 
-                text_msg = reply_with_quick(f"你抽到的是：{name_text}！")
-                messages.append(text_msg)
+            text_msg = reply_with_quick(f"你抽到的是：{name_text}！")
+            messages.append(text_msg)
 
-            else:
-                messages = handle_emotion_message(user_input, user_id, title, name)
-                if messages is None:
-                    messages = handle_general_chat(user_id, user_input, title, name)
+        else:
+            messages = handle_emotion_message(user_input, user_id, title, name)
+            if messages is None:
+                allowed, retry_after, scope = ai_rate_limiter.acquire(user_id)
+                if allowed:
+                    messages = handle_general_chat(user_id, user_input, title, name, deadline)
+                else:
+                    logging.info(f"🚦 {user_id} 的 AI 請求被頻率限制（{scope}）")
+                    messages = [reply_with_quick(get_rate_limited_text(scope, retry_after))]
 
-            messages = add_quick_reply(messages)
-            safe_reply(line_bot_api, user_id, event.reply_token, messages)
+        messages = add_quick_reply(messages)
+        safe_reply(line_bot_api, user_id, event.reply_token, messages)
 
     except Exception as e:
         logging.exception("處理訊息錯誤: %s", str(e))
 
 
-@handler.add(MessageEvent, message=LocationMessageContent)
-def handle_location(event):
+@route_event(MessageEvent, message=LocationMessageContent)
+def handle_location(event, received_at=None):
     try:
         lat, lon = event.message.latitude, event.message.longitude
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            profile = line_bot_api.get_profile(event.source.user_id)
-            name = profile.display_name
-            city = reverse_geocode_to_city(lat, lon)
-            save_user_city(name, city)
-            reply = f"你目前所在的縣市是：{city}，已為你更新天氣設定。"
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text=reply)])
-            )
+        line_bot_api = line_client.get()
+        name = profile_cache.get_display_name(event.source.user_id)
+        city = reverse_geocode_to_city(lat, lon)
+        save_user_city(name, city)
+        reply = f"你目前所在的縣市是：{city}，已為你更新天氣設定。"
+        safe_reply(line_bot_api, event.source.user_id, event.reply_token, [TextMessage(text=reply)])
     except Exception as e:
         logging.exception("處理位置訊息錯誤: %s", str(e))
 
 
+@route_event(FollowEvent)
+@route_event(UnfollowEvent)
+def handle_follow_change(event, received_at=None):
+    # 加入／封鎖時暱稱可能已變更，下次使用時重新向 LINE 取得
+    profile_cache.invalidate(event.source.user_id)
+    logging.info(f"👋 {type(event).__name__}：{event.source.user_id}")
+
+
 @app.route("/Pic/<filename>")
 def serve_image(filename):
     return send_from_directory("Pic", filename)
@@ -927,7 +3095,7 @@ def test_ollama():
     lines.append(f"Model: {OLLAMA_TUNNEL_MODEL}\n")
 
     try:
-        r = requests.get(
+        r = http_get(
             f"{OLLAMA_TUNNEL_URL}/api/tags",
             headers={"X-LT-Token": OLLAMA_TUNNEL_TOKEN},
             timeout=10
@@ -944,7 +3112,7 @@ def test_ollama():
     lines.append("")
 
     try:
-        r = requests.post(
+        r = http_post(
             f"{OLLAMA_TUNNEL_URL}/api/chat",
             headers={"Content-Type": "application/json", "X-LT-Token": OLLAMA_TUNNEL_TOKEN},
             json={
@@ -966,7 +3134,53 @@ def test_ollama():
     return "\n".join(lines), 200, {"Content-Type": "text/plain; charset=utf-8"}
 
 
+# 即時數值：抓取時才讀
+metrics.gauge("event_queue_depth", "Events waiting for or in event workers", event_dispatcher.pending)
+metrics.gauge("usage_queue_depth", "Usage log lines waiting to be written", lambda: usage_recorder.queue.qsize())
+metrics.gauge(
+    "llm_backend_in_flight", "LLM requests running per provider",
+    lambda: {(name,): b.in_flight for name, b in AI_BACKENDS.items()}, ("source",)
+)
+metrics.gauge(
+    "llm_backend_waiting", "LLM requests waiting for a concurrency slot per provider",
+    lambda: {(name,): b.waiting for name, b in AI_BACKENDS.items()}, ("source",)
+)
+metrics.gauge(
+    "llm_circuit_open", "1 when the provider's circuit breaker is open",
+    lambda: {(name,): int(provider_health.providers.get(name, {}).get("opened_at") is not None) for name in AI_BACKENDS},
+    ("source",)
+)
+metrics.gauge("ai_rate_limited_total", "AI chat requests rejected by the rate limiter", lambda: ai_rate_limiter.limited, kind="counter")
+metrics.gauge("profile_cache_entries", "Display names held in the profile cache", lambda: len(profile_cache.entries))
+metrics.gauge("memory_cache_entries", "Users whose history is held in memory", lambda: len(memory_store.cache))
+
+job_started_at = {}
+
+
+def record_job_event(event):
+    job = "scheduled_message" if event.job_id.startswith("msg_") else event.job_id
+    if event.code == EVENT_JOB_SUBMITTED:
+        job_started_at[event.job_id] = time.perf_counter()
+        return
+    started = job_started_at.pop(event.job_id, None)
+    if started is not None:
+        scheduler_job_seconds.observe(time.perf_counter() - started, job)
+    if event.code == EVENT_JOB_ERROR:
+        scheduler_job_errors_total.inc(job)
+
+
+scheduler.add_listener(record_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 if __name__ == "__main__":
     start_scheduler()
+    event_dispatcher.start()
     port = int(os.environ.get("PORT", 5050))
     serve(app, host="0.0.0.0", port=port)
@@ -0,0 +1,41 @@
+# 一次性工具：從 PokeAPI 抓取所有寶可夢的基本資料，輸出 app.py 使用的 pokemon_index.json
+# 用法：python build_pokemon_index.py [最大編號]
+import sys
+import json
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+OUTPUT_FILE = "pokemon_index.json"
+MAX_ID = int(sys.argv[1]) if len(sys.argv) > 1 else 1010
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_maxsize=8,
+    max_retries=Retry(total=5, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))
+))
+
+
+def fetch(pokemon_id):
+    data = session.get(f"https://pokeapi.co/api/v2/pokemon/{pokemon_id}", timeout=15).json()
+    species_data = session.get(data['species']['url'], timeout=15).json()
+    return {
+        "id": data['id'],
+        "name_en": data['name'].capitalize(),
+        "name_zh": next((n['name'] for n in species_data.get("names", []) if n['language']['name'] == 'zh-Hant'), ""),
+        "types": [t['type']['name'] for t in data['types']],
+        "height": data['height'] / 10,
+        "weight": data['weight'] / 10,
+        "image": data['sprites']['other']['official-artwork']['front_default'],
+    }
+
+
+if __name__ == "__main__":
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        index = list(executor.map(fetch, range(1, MAX_ID + 1)))
+
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    print(f"✅ 已寫入 {len(index)} 隻寶可夢到 {OUTPUT_FILE}")